@@ -0,0 +1,56 @@
+"""Record the cassette the benchmarks replay.
+
+Runs run.session() against tests/stub.py and records every response,
+keyed on the real API URLs, so run.py can replay it with the default
+URLS. Rerun this when the stub or the cases change:
+
+    python benchmarks/record.py [--products 100] [--cassette benchmarks/cassette.jsonl]
+"""
+import argparse
+import os
+from urllib.parse import urlsplit
+
+import run
+from run import pizza
+from stub import StubServer, make_menu
+
+
+class StubTransport(pizza.Transport):
+    """A Transport that sends requests for the real API hosts to the stub."""
+    def __init__(self, url, **kwargs):
+        super(StubTransport, self).__init__(**kwargs)
+        self.url = url
+
+    def rewrite(self, url):
+        parts = urlsplit(url)
+        return self.url + url[len('%s://%s' % (parts.scheme, parts.netloc)):]
+
+    def get(self, url, **kwargs):
+        return super(StubTransport, self).get(self.rewrite(url), **kwargs)
+
+    def post(self, url, **kwargs):
+        return super(StubTransport, self).post(self.rewrite(url), **kwargs)
+
+
+def record(path, products=100):
+    if os.path.exists(path):
+        os.remove(path)
+    with StubServer(make_menu(products=products)) as server:
+        pizza.set_transport(pizza.RecordingTransport(path, StubTransport(server.url, retries=0)))
+        try:
+            run.session()
+        finally:
+            pizza.set_transport(pizza.Transport())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--products', type=int, default=100, help='products on the menu (default 100)')
+    parser.add_argument('--cassette', default=run.CASSETTE)
+    args = parser.parse_args(argv)
+    record(args.cassette, args.products)
+    print('recorded %s' % args.cassette)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,382 @@
+"""Benchmarks for pizza, replayed from a recorded cassette.
+
+Every case that talks to the API goes through a ReplayTransport serving
+cassette.jsonl (see record.py), so runs are offline and repeatable and
+only measure this library. The async flows need a real socket and run
+against tests/stub.py instead.
+
+    python benchmarks/run.py                 # every case
+    python benchmarks/run.py menu retained   # the cases starting with these
+    python benchmarks/run.py -n 50           # fewer runs per case
+
+Each case reports the p50, p90, p99 and max of its runs in milliseconds,
+and the peak memory allocated during one more run under tracemalloc.
+The retained_* cases report instead the memory still held by what they
+build, e.g. one cached menu in each Menu mode.
+"""
+import argparse
+import asyncio
+import gc
+import io
+import os
+import py_compile
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'tests')]
+
+import pizza  # noqa: E402
+from stub import TRACKER_STATUS, TRACKER_XML, StubServer  # noqa: E402
+
+CASSETTE = os.path.join(HERE, 'cassette.jsonl')
+STORE_ID = 1
+
+
+def scan(variants, **conditions):
+    """Menu.search as it was before MenuIndex: a scan of every variant,
+    parsing its toppings and matching each condition as a substring."""
+    results = []
+    for v in variants.values():
+        toppings = dict(x.split('=', 1) for x in v['Tags']['DefaultToppings'].split(',') if x)
+        fields = dict(v, Toppings=toppings)
+        if all(y in fields.get(x, '') for x, y in conditions.items()):
+            results.append(v)
+    return results
+
+
+def customer():
+    return pizza.Customer('Ann', 'Baker', 'ann@example.com', '5555550100',
+                          '1 Main St, Springfield, IL, 62701')
+
+
+def session():
+    """The API calls a cassette has to hold for the cases below."""
+    menu = pizza.Menu.from_store(STORE_ID, cache=False)
+    store = customer().address.closest_store()
+    order = pizza.Order(store, customer(), menu=menu)
+    order.add_item('12P1', 2)
+    order.price()
+    order.validate()
+    order.place()
+    pizza.track_by_phone('5555550100')
+    pizza.track_by_order(STORE_ID, 'A1')
+
+
+class Cases(object):
+    """The benchmark cases: run_<name> methods, timed one call at a time.
+
+    setup_<name>, if there is one, is called once before the runs.
+    retained_<name> methods return what they build, to be measured by
+    the memory it keeps (see retained()).
+    """
+    def __init__(self):
+        self.customer = customer()
+        self.menu_body = pizza.get_transport().get(
+            pizza.format_url(pizza.Urls().menu_url(), store_id=STORE_ID, lang='en')).content
+        self.menu = pizza.Menu.from_json(self.menu_body)
+        self.store = pizza.Store({'StoreID': STORE_ID})
+        self.codes = sorted(self.menu.variants)[:20]
+
+    def order(self, *codes):
+        order = pizza.Order(self.store, self.customer, menu=self.menu)
+        for code in codes:
+            order.add_item(code)
+        return order
+
+    # Menus
+    def run_menu_parse_eager(self):
+        pizza.Menu.from_json(self.menu_body)
+
+    def run_menu_parse_lazy(self):
+        pizza.Menu.from_json(self.menu_body, lazy=True)
+
+    def run_menu_parse_compact(self):
+        pizza.Menu.from_json(self.menu_body, lazy=True, compact=True)
+
+    def run_menu_index(self):
+        pizza.MenuIndex(self.menu.variants)
+
+    # The same queries through the index and by scanning every variant
+    def setup_menu_search(self):
+        self.menu.index
+
+    def run_menu_search(self):
+        self.menu.search(Name='Pepperoni', SizeCode='12')
+        self.menu.search(ProductCode='S_P99')
+        self.menu.search(Toppings='X')
+
+    def run_menu_search_scan(self):
+        scan(self.menu.variants, Name='Pepperoni', SizeCode='12')
+        scan(self.menu.variants, ProductCode='S_P99')
+        scan(self.menu.variants, Toppings='X')
+
+    def run_menu_search_fuzzy(self):
+        self.menu.search(Name='chese', fuzzy=True)
+
+    def run_menu_render(self):
+        self.menu._tree = None
+        for _ in self.menu.render():
+            pass
+
+    def run_menu_from_store(self):
+        pizza.Menu.from_store(STORE_ID, cache=False)
+
+    # A menu kept in a cache, in each mode: the decoded JSON is dropped
+    def retained_menu_eager(self):
+        return pizza.Menu.from_json(self.menu_body)
+
+    def retained_menu_eager_raw(self):
+        return pizza.Menu.from_json(self.menu_body, keep_raw=True)
+
+    def retained_menu_compact(self):
+        return pizza.Menu.from_json(self.menu_body, compact=True)
+
+    def retained_menu_compact_raw(self):
+        return pizza.Menu.from_json(self.menu_body, compact=True, keep_raw=True)
+
+    def retained_menu_lazy(self):
+        return pizza.Menu.from_json(self.menu_body, lazy=True)
+
+    def retained_menu_lazy_compact(self):
+        return pizza.Menu.from_json(self.menu_body, lazy=True, compact=True)
+
+    def retained_menu_lazy_compact_used(self):
+        menu = pizza.Menu.from_json(self.menu_body, lazy=True, compact=True)
+        menu.search(Name='pepperoni')
+        return menu.materialize()
+
+    def run_json_decode(self):
+        pizza.decode_json(self.menu_body)
+
+    def run_json_decode_stdlib(self):
+        import json
+        json.loads(self.menu_body)
+
+    # Carts and orders
+    def run_cart_add_remove(self):
+        order = self.order()
+        for code in self.codes:
+            order.add_item(code)
+            order.add_item(code)
+        for code in self.codes:
+            order.remove_item(code)
+            order.remove_item(code)
+
+    def setup_order_body(self):
+        self.body_order = self.order(*self.codes)
+
+    def run_order_body(self):
+        self.body_order.data['Address']['Street'] = str(random.random())
+        self.body_order._body()
+
+    def run_order_estimate(self):
+        self.order(*self.codes).estimate()
+
+    def run_order_flow(self):
+        order = self.order('12P1', '12P1')
+        order.price()
+        order.validate()
+        order.place()
+
+    def run_order_pipeline(self):
+        orders = [self.order('12P1') for _ in range(20)]
+        for result in pizza.place_orders(orders, workers=8, rate=0):
+            if result.error is not None:
+                raise result.error
+
+    def setup_coupons_best(self):
+        # Deals on pizzas or sides, like "any 2 pizzas" or "a pizza and 2 sides"
+        rnd = random.Random(1)
+        products = sorted(set(v['ProductCode'] for v in self.menu.variants.values()))
+        pizzas, sides = frozenset(products[:6]), frozenset(products[6:10])
+        self.catalog = pizza.CouponCatalog(
+            pizza.Coupon('C%d' % i, price=float(rnd.randint(8, 30)),
+                         groups=tuple((rnd.randint(1, 3), rnd.choice([pizzas, sides]))
+                                      for _ in range(rnd.randint(1, 3))))
+            for i in range(30))
+        self.coupon_order = self.order()
+        for product in products[:10]:
+            self.coupon_order.add_item('%sP%s' % (rnd.choice(['10', '12', '14']), product[3:]),
+                                       rnd.randint(1, 3))
+
+    def run_coupons_best(self):
+        self.catalog.best(self.coupon_order)
+
+    def setup_queue_put(self):
+        self.queue_dir = tempfile.mkdtemp()
+        self.queue_order = self.order('12P1')
+
+    def run_queue_put(self):
+        # 256 orders from 16 threads share the log's fsyncs
+        path = os.path.join(self.queue_dir, 'orders.wal')
+        queue = pizza.OrderQueue(path)
+        threads = [threading.Thread(target=lambda: [queue.put(self.queue_order) for _ in range(16)])
+                   for _ in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        queue.close()
+        os.remove(path)
+
+    # Stores, tracking and cards
+    def run_store_lookup(self):
+        self.customer.address.nearby_stores(cache=False)
+
+    def run_store_lookup_cached(self):
+        self.customer.address.nearby_stores()
+
+    def setup_tracker_xml(self):
+        statuses = ''.join(TRACKER_STATUS.format(store=STORE_ID, order=i, phone='5555550100', status='Oven')
+                           for i in range(500))
+        self.tracker_xml = TRACKER_XML.format(statuses).encode()
+
+    def run_tracker_xml(self):
+        import xmltodict
+        pizza.order_statuses(xmltodict.parse(self.tracker_xml))
+
+    def run_tracker_xml_stream(self):
+        for _ in pizza.iter_order_statuses(io.BytesIO(self.tracker_xml)):
+            pass
+
+    def run_tracker_phone(self):
+        pizza.track_by_phone('5555550100')
+
+    def setup_cards_classify(self):
+        rnd = random.Random(1)
+        prefixes = ('4', '51', '37', '6011', '35', '36')
+        self.cards = [rnd.choice(prefixes) + ''.join(rnd.choice('0123456789') for _ in range(14))
+                      for _ in range(1000)]
+
+    def run_cards_classify(self):
+        pizza.validate_cards(self.cards)
+
+    def setup_import_time(self):
+        # Time the import, not compiling pizza.py, which PYTHONDONTWRITEBYTECODE would redo every run
+        py_compile.compile(os.path.join(ROOT, 'pizza.py'), doraise=True)
+
+    def run_import_time(self):
+        # Only 'import pizza' in a fresh interpreter, without the interpreter's own start up
+        code = 'import time; start = time.perf_counter(); import pizza; print(time.perf_counter() - start)'
+        return float(subprocess.check_output([sys.executable, '-c', code], cwd=ROOT))
+
+    # Async flows, against the stub server
+    def setup_async_flow(self):
+        self.stub = StubServer(pizza.decode_json(self.menu_body)).__enter__()
+
+    def run_async_flow(self):
+        # 50 concurrent price and place flows, and 50 menu fetches sharing one download
+        async def flow(order):
+            await order.price()
+            await order.place()
+
+        async def main():
+            pizza.register_country(pizza.COUNTRY_USA, self.stub.url)
+            pizza.set_menu_cache(pizza.MenuCache())
+            store = pizza.AsyncStore({'StoreID': STORE_ID})
+            try:
+                await asyncio.gather(*[store.get_menu() for _ in range(50)])
+                orders = [pizza.AsyncOrder(store, self.customer, menu=self.menu) for _ in range(50)]
+                for order in orders:
+                    order.add_item('12P1')
+                await asyncio.gather(*[flow(order) for order in orders])
+            finally:
+                await pizza.get_async_transport().close()
+                pizza.register_country(pizza.COUNTRY_USA, 'https://order.dominos.com',
+                                       'https://trkweb.dominos.com')
+        asyncio.run(main())
+
+    def teardown_async_flow(self):
+        self.stub.__exit__(None, None, None)
+
+
+# Slow cases run fewer times
+RUNS = {'import_time': 10, 'queue_put': 10, 'async_flow': 10, 'order_pipeline': 20,
+        'menu_parse_eager': 50, 'menu_from_store': 50}
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return [pizza.HistogramMetrics.percentile(samples, p) for p in (50, 90, 99)] + [samples[-1]]
+
+
+def measure(cases, name, runs):
+    """Time runs calls of a case, then one more under tracemalloc.
+
+    A case that returns a number has timed itself, in seconds, e.g. in
+    a subprocess, and that is used instead of the time of the call.
+    """
+    run = getattr(cases, 'run_' + name)
+    getattr(cases, 'setup_' + name, lambda: None)()
+    try:
+        run()
+        samples = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            seconds = run()
+            if seconds is None:
+                seconds = time.perf_counter() - start
+            samples.append(seconds * 1000)
+        tracemalloc.start()
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    finally:
+        getattr(cases, 'teardown_' + name, lambda: None)()
+    return percentiles(samples), peak
+
+
+def retained(cases, name, runs=3):
+    """The bytes still allocated for what a retained_ case builds.
+
+    The smallest of a few runs, as the first ones can also pay for
+    growing interpreter-wide tables such as the interned strings.
+    """
+    build = getattr(cases, 'retained_' + name)
+    sizes = []
+    for _ in range(runs):
+        gc.collect()
+        tracemalloc.start()
+        kept = build()
+        gc.collect()
+        sizes.append(tracemalloc.get_traced_memory()[0])
+        tracemalloc.stop()
+        del kept
+    return min(sizes)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('cases', nargs='*', help='only run the cases starting with these')
+    parser.add_argument('-n', '--runs', type=int, default=200, help='runs per case (default 200)')
+    parser.add_argument('--cassette', default=CASSETTE)
+    args = parser.parse_args(argv)
+
+    pizza.set_transport(pizza.ReplayTransport(args.cassette, match_body=False))
+    cases = Cases()
+    names = sorted(name[4:] for name in dir(cases) if name.startswith('run_'))
+    kept = sorted('retained_' + name[9:] for name in dir(cases) if name.startswith('retained_'))
+    if args.cases:
+        names = [name for name in names if name.startswith(tuple(args.cases))]
+        kept = [name for name in kept if name.startswith(tuple(args.cases))]
+    if names:
+        print('%-32s %9s %9s %9s %9s %10s' % ('case', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'peak KiB'))
+    for name in names:
+        runs = min(args.runs, RUNS.get(name, args.runs))
+        times, peak = measure(cases, name, runs)
+        print('%-32s %9.3f %9.3f %9.3f %9.3f %10.1f' % ((name,) + tuple(times) + (peak / 1024.0,)))
+    if kept:
+        print('\n%-32s %10s' % ('case', 'kept KiB'))
+    for name in kept:
+        print('%-32s %10.1f' % (name, retained(cases, name[9:]) / 1024.0))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,11 +3,28 @@
 # Original API by Gamagori and RIAEvangelist
 # Last updated 12/09/2018
 
-import requests
-import xmltodict
+# requests, xmltodict, aiohttp and the heavier parts of the standard library
+# are imported where they are first used, so `import pizza` stays fast for
+# code that never talks to the API (cards, addresses, cached menus).
+import bisect
+import functools
+import json
+import heapq
+import io
+import marshal
+import mmap
+import os
+import queue
 import re
-
-COUNTRY = COUNTRY_USA
+import string
+import struct
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict, namedtuple
+from types import MappingProxyType
+from urllib.parse import quote, urlsplit
 
 # TODO: Add more countries/regions
 COUNTRY_USA = 'us'
@@ -16,8 +33,363 @@ COUNTRY_UK = 'uk'
 COUNTRY_INDIA = 'in'
 COUNTRY_JAPAN = 'jp'
 
+COUNTRY = COUNTRY_USA
+
+
+# Connect and read timeouts (in seconds) for every call to the API
+TIMEOUT = (3.05, 15)
+# How many times a GET is retried on connection errors and 5xx responses
+RETRIES = 3
+BACKOFF = 0.3
+POOL_SIZE = 10
+RETRY_STATUSES = (500, 502, 503, 504)
+
+
+class Transport(object):
+    """Pooled, keep-alive HTTP sessions for talking to the API.
+
+    The Transport keeps one requests.Session per host (the hosts in Urls),
+    so the price, validate and place calls of an order all reuse the same
+    TLS connection instead of doing a new handshake every time.
+
+    Every request gets a timeout. GET requests are retried with exponential
+    backoff; POSTs are never retried, because retrying place-order blindly
+    could place the same order twice.
+    """
+    def __init__(self, timeout=TIMEOUT, retries=RETRIES, backoff=BACKOFF,
+                 pool_size=POOL_SIZE):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return "Transport with {} open sessions".format(len(self.sessions))
+
+    def session(self, url):
+        host = urlsplit(url).netloc
+        session = self.sessions.get(host)
+        if session is None:
+            with self.lock:
+                session = self.sessions.get(host)
+                if session is None:
+                    session = self.sessions[host] = self.new_session()
+        return session
+
+    def new_session(self):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        retry = Retry(
+            total=self.retries,
+            backoff_factor=self.backoff,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset(['GET']),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_maxsize=self.pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session(url).get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session(url).post(url, **kwargs)
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
+
+
+_transport = Transport()
+
+
+def get_transport():
+    return _transport
+
+
+def set_transport(transport):
+    """Replace the Transport used by every call to the API.
+
+    Use this to change timeouts, retries or pool sizes for the whole module,
+    e.g. set_transport(Transport(timeout=(1, 5), retries=0)).
+    """
+    global _transport
+    old, _transport = _transport, transport
+    if old is not transport:
+        old.close()
+    return transport
+
+
+def _request_key(method, url, body=None, match_body=True):
+    import hashlib
+    digest = hashlib.sha1(body).hexdigest() if body and match_body else ''
+    return '{} {} {}'.format(method, url, digest)
+
+
+def _request_body(kwargs):
+    if 'json' in kwargs:
+        return json.dumps(kwargs['json']).encode()
+    data = kwargs.get('data')
+    return data.encode() if isinstance(data, str) else data
+
+
+class RecordingTransport(object):
+    """A Transport that writes every response it gets to a cassette file.
+
+    The cassette is a file of JSON lines, one per request, which
+    ReplayTransport can serve back later without any network access.
+    """
+    def __init__(self, path, transport=None):
+        self.path = path
+        self.transport = transport or Transport()
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return "RecordingTransport to {}".format(self.path)
+
+    def record(self, method, url, body, r):
+        content = r.content
+        r.raw = io.BytesIO(content)
+        entry = {
+            'key': _request_key(method, url, body),
+            'unmatched_key': _request_key(method, url),
+            'status': r.status_code,
+            'headers': dict(r.headers),
+            'content': content.decode('utf-8', 'surrogateescape'),
+        }
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+        return r
+
+    def get(self, url, **kwargs):
+        return self.record('GET', url, None, self.transport.get(url, **kwargs))
+
+    def post(self, url, **kwargs):
+        return self.record('POST', url, _request_body(kwargs), self.transport.post(url, **kwargs))
+
+    def close(self):
+        self.transport.close()
+
+
+class ReplayTransport(object):
+    """A Transport that serves responses from a RecordingTransport cassette.
+
+    Requests are matched on method, URL and (for POSTs, unless
+    match_body=False) the exact request body. Responses recorded for the
+    same request are served in order, the last one over and over. A
+    request with nothing recorded raises an Exception.
+    """
+    def __init__(self, path, match_body=True):
+        self.path = path
+        self.match_body = match_body
+        self.responses = {}
+        self.served = {}
+        self.lock = threading.Lock()
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    key = entry['key'] if match_body else entry['unmatched_key']
+                    self.responses.setdefault(key, []).append(entry)
+
+    def __repr__(self):
+        return "ReplayTransport of {} requests from {}".format(len(self.responses), self.path)
+
+    def replay(self, method, url, body):
+        key = _request_key(method, url, body, self.match_body)
+        entries = self.responses.get(key)
+        if not entries:
+            raise Exception('no recorded response for %s %s' % (method, url))
+        with self.lock:
+            i = self.served.get(key, 0)
+            self.served[key] = i + 1
+        entry = entries[min(i, len(entries) - 1)]
+        import requests
+        content = entry['content'].encode('utf-8', 'surrogateescape')
+        r = requests.Response()
+        r.status_code = entry['status']
+        r.headers.update(entry['headers'])
+        r.url = url
+        r._content = content
+        r.raw = io.BytesIO(content)
+        return r
+
+    def get(self, url, **kwargs):
+        return self.replay('GET', url, None)
+
+    def post(self, url, **kwargs):
+        return self.replay('POST', url, _request_body(kwargs))
+
+    def close(self):
+        pass
+
+
+class Metrics(object):
+    """Instrumentation hooks for the whole module. Override what you need.
+
+    Install one with set_metrics(). When none is installed the hooks are
+    never called and nothing is timed, so instrumentation costs nothing.
+
+    request: every call to the API, with the endpoint's name in Urls (e.g.
+        'menu_url'), its country, the HTTP method and status, the seconds
+        it took and the bytes received and sent.
+    phase: CPU-bound work, e.g. 'json.decode', 'xml.parse',
+        'menu.compact', 'menu.items', 'menu.categories', 'menu.index',
+        'menu.tree', 'menu.update' and 'order.encode', with the seconds it
+        took.
+    stage: an order's price, validate and place calls as a whole
+        (encoding, the request and merging the response).
+    """
+    def request(self, endpoint, country, method, status, seconds, received, sent=0):
+        pass
+
+    def phase(self, name, seconds):
+        pass
+
+    def stage(self, name, seconds):
+        pass
+
+
+class HistogramMetrics(Metrics):
+    """Metrics that keeps every sample in memory, for benchmarking.
+
+    Samples are grouped by name: 'request.<endpoint>.seconds',
+    'request.<endpoint>.bytes', 'phase.<name>' and 'stage.<name>'.
+    summary() reports their count, mean and percentiles.
+    """
+    def __init__(self):
+        self.samples = {}
+        self.statuses = {}
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return "HistogramMetrics of {} series".format(len(self.samples))
+
+    def add(self, name, value):
+        with self.lock:
+            self.samples.setdefault(name, []).append(value)
+
+    def request(self, endpoint, country, method, status, seconds, received, sent=0):
+        self.add('request.%s.seconds' % endpoint, seconds)
+        self.add('request.%s.bytes' % endpoint, received + sent)
+        with self.lock:
+            key = (endpoint, status)
+            self.statuses[key] = self.statuses.get(key, 0) + 1
+
+    def phase(self, name, seconds):
+        self.add('phase.%s' % name, seconds)
+
+    def stage(self, name, seconds):
+        self.add('stage.%s' % name, seconds)
+
+    @staticmethod
+    def percentile(values, p):
+        return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+    def summary(self):
+        summary = {}
+        with self.lock:
+            series = dict((name, sorted(values)) for name, values in self.samples.items())
+        for name, values in series.items():
+            summary[name] = {
+                'count': len(values),
+                'mean': sum(values) / len(values),
+                'p50': self.percentile(values, 50),
+                'p90': self.percentile(values, 90),
+                'p99': self.percentile(values, 99),
+                'max': values[-1],
+            }
+        return summary
+
+    def clear(self):
+        with self.lock:
+            self.samples.clear()
+            self.statuses.clear()
+
+
+_metrics = None
+
+
+def get_metrics():
+    return _metrics
+
+
+def set_metrics(metrics):
+    """Install a Metrics for the whole module, or None to turn it off."""
+    global _metrics
+    _metrics = metrics
+    return metrics
+
+
+_endpoints = None
+
+
+def endpoint_name(url):
+    """The (country, name) of an endpoint URL template in Urls, if it is one."""
+    global _endpoints
+    if _endpoints is None:
+        _endpoints = dict((template, (country, name))
+                          for country, endpoints in URLS.items()
+                          for name, template in endpoints.items())
+    return _endpoints.get(url, (None, urlsplit(url).path))
+
+
+def _record_request(url, method, start, status, received, sent=0):
+    country, endpoint = endpoint_name(url)
+    _metrics.request(endpoint, country, method, status,
+                     time.perf_counter() - start, received, sent)
+
+
+def _record_phase(name, start):
+    _metrics.phase(name, time.perf_counter() - start)
+    return time.perf_counter()
+
+
+# JSON backends tried in order; the standard library's json is the fallback
+JSON_DECODERS = ('orjson', 'ujson')
+_json_loads = None
+
+
+def set_json_decoder(loads):
+    """Use loads (a function of bytes or str) to decode every JSON response.
+
+    Pass None to pick the fastest installed backend in JSON_DECODERS again.
+    """
+    global _json_loads
+    _json_loads = loads
+    return loads
+
+
+def decode_json(content):
+    """Decode a JSON response body, straight from bytes where the backend can."""
+    global _json_loads
+    if _json_loads is None:
+        _json_loads = json.loads
+        for name in JSON_DECODERS:
+            try:
+                _json_loads = __import__(name).loads
+                break
+            except ImportError:
+                continue
+    if _metrics is None:
+        return _json_loads(content)
+    start = time.perf_counter()
+    data = _json_loads(content)
+    _record_phase('json.decode', start)
+    return data
+
 
-# TODO: Find out why this occasionally hangs
 # TODO: Can we wrap this up, so the callers don't have to worry about the 
 # complexity of two types of requests? 
 
@@ -25,13 +397,39 @@ def request_json(url, **kwargs):
     """Send a GET request to one of the API endpoints that returns JSON.
 
     Send a GET request to an endpoint, ideally a URL from the urls module.
-    The endpoint is formatted with the kwargs passed to it.
+    The endpoint is filled in with the kwargs passed to it (see format_url).
 
     This will error on an invalid request (requests.Request.raise_for_status()), but will otherwise return a dict.
     """
-    r = requests.get(url.format(**kwargs))
+    start = time.perf_counter() if _metrics is not None else None
+    r = _transport.get(format_url(url, **kwargs))
+    if start is not None:
+        _record_request(url, 'GET', start, r.status_code, len(r.content))
+    r.raise_for_status()
+    return decode_json(r.content)
+
+
+def request_json_if_modified(url, etag=None, last_modified=None, **kwargs):
+    """Like request_json, but only download the response if it has changed.
+
+    etag and last_modified are the validators of an earlier response, sent
+    as If-None-Match and If-Modified-Since. Returns (data, etag,
+    last_modified); data is None, and nothing is decoded, if the server
+    answers 304 Not Modified.
+    """
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    start = time.perf_counter() if _metrics is not None else None
+    r = _transport.get(format_url(url, **kwargs), headers=headers)
+    if start is not None:
+        _record_request(url, 'GET', start, r.status_code, len(r.content))
+    if r.status_code == 304:
+        return None, etag, last_modified
     r.raise_for_status()
-    return r.json()
+    return decode_json(r.content), r.headers.get('ETag'), r.headers.get('Last-Modified')
 
 
 def request_xml(url, **kwargs):
@@ -39,11 +437,145 @@ def request_xml(url, **kwargs):
     
     This is in every respect identical to request_json. 
     """
-    r = requests.get(url.format(**kwargs))
+    import xmltodict
+    start = time.perf_counter() if _metrics is not None else None
+    r = _transport.get(format_url(url, **kwargs))
+    if start is None:
+        r.raise_for_status()
+        return xmltodict.parse(r.text)
+    _record_request(url, 'GET', start, r.status_code, len(r.content))
     r.raise_for_status()
-    return xmltodict.parse(r.text)
+    start = time.perf_counter()
+    document = xmltodict.parse(r.text)
+    _record_phase('xml.parse', start)
+    return document
+
+
+
+
+# Names of the order lifecycle stages reported to Metrics.stage
+ORDER_STAGES = {'price_url': 'price', 'validate_url': 'validate', 'place_url': 'place'}
+
+ORDER_HEADERS = {
+    'Referer': 'https://order.dominos.com/en/pages/order/',
+    'Content-Type': 'application/json'
+}
 
 
+# Variant fields copied onto each cart line
+LINE_FIELDS = ('Code', 'Name', 'Price', 'ProductCode', 'SizeCode', 'FlavorCode')
+
+
+class Cart(object):
+    """The product (or coupon) lines of an Order.
+
+    Every line is a small dict of its own, built from the variant's
+    LINE_FIELDS, so no two lines and no line and the (possibly shared)
+    Menu ever alias the same dict. Lines are indexed by ID and by code,
+    so adding, merging and removing are all O(1): adding a code that is
+    already in the cart with the same options only bumps its Qty, and
+    remove() takes back exactly what the last add() of that code put in.
+    """
+    def __init__(self):
+        self.lines = OrderedDict()
+        self.by_code = {}
+        self.by_key = {}
+        self.added = {}
+        self.next_id = 1
+        self.version = 0
+        self._list = ([], 0)
+
+    def __repr__(self):
+        return "Cart with {} lines".format(len(self.lines))
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __iter__(self):
+        return iter(self.lines.values())
+
+    def __contains__(self, code):
+        return code in self.by_code
+
+    @staticmethod
+    def options(options):
+        """Normalize item options to the API's {code: {portion: amount}} form.
+
+        Accepts a list of topping codes (each on the whole item, normal
+        amount), a dict of code to amount, or the API's own form.
+        """
+        if not options:
+            return {}
+        if not isinstance(options, dict):
+            options = dict((code, '1') for code in options)
+        return dict((code, amount if isinstance(amount, dict) else {'1/1': str(amount)})
+                    for code, amount in options.items())
+
+    def add(self, code, template, qty=1, options=None):
+        options = self.options(options)
+        key = (code, json.dumps(options, sort_keys=True))
+        line_id = self.by_key.get(key)
+        self.version += 1
+        if line_id is not None:
+            line = self.lines[line_id]
+            line['Qty'] += qty
+            self.added[line_id].append(qty)
+            self.by_code[code].move_to_end(line_id)
+            return line
+        line = dict((k, template[k]) for k in LINE_FIELDS if k in template)
+        line.update(Code=code, ID=self.next_id, isNew=True, Qty=qty, AutoRemove=False)
+        if options:
+            line['Options'] = options
+        self.lines[line['ID']] = line
+        self.added[line['ID']] = [qty]
+        self.by_code.setdefault(code, OrderedDict())[line['ID']] = key
+        self.by_key[key] = line['ID']
+        self.next_id += 1
+        return line
+
+    def remove(self, code, qty=None):
+        """Take qty of a code out of the cart, from its most recently added line.
+
+        qty defaults to the quantity that line was last added with, so
+        remove() undoes one add(). The line goes once its Qty reaches 0.
+        """
+        ids = self.by_code.get(code)
+        if not ids:
+            raise Exception('"%s" is not in the order' % code)
+        self.version += 1
+        line_id, key = next(reversed(ids.items()))
+        line = self.lines[line_id]
+        added = self.added[line_id]
+        qty = added.pop() if qty is None else qty
+        if line['Qty'] > qty:
+            line['Qty'] -= qty
+            if not added:
+                added.append(line['Qty'])
+            return line
+        del ids[line_id]
+        if not ids:
+            del self.by_code[code]
+        del self.by_key[key]
+        del self.added[line_id]
+        return self.lines.pop(line_id)
+
+    def to_list(self):
+        """The lines as a list; the same list object until the cart changes."""
+        lines, version = self._list
+        if version != self.version:
+            lines = list(self.lines.values())
+            self._list = (lines, self.version)
+        return lines
+
+
+# Fields of order.data filled from the Carts, whose encoding Order._body keeps
+CART_FIELDS = ('Products', 'Coupons')
+
+
+# Fields of the API's Order response that are copied back into Order.data
+MERGE_KEYS = ('Amounts', 'AmountsBreakdown', 'BusinessDate', 'Currency',
+              'CustomerID', 'EstimatedWaitMinutes', 'Market', 'OrderID',
+              'PriceOrderTime', 'StoreID')
 
 
 # TODO: Add add_coupon and remove_coupon methods
@@ -53,10 +585,27 @@ class Order(object):
     The Order is perhaps the second most complicated class - it wraps
     up all the logic for actually placing the order, after we've
     determined what we want from the Menu. 
+
+    Editing the cart is free: estimate() and check() price and validate
+    the order locally from the menu, and price() and validate() only go to
+    the API when the cart changed since their last call (see dirty). If
+    you edit order.data directly, call changed() afterwards, with the
+    names of the fields you edited if you know them.
+
+    The cart lives in order.products and order.coupons (see Cart); the
+    Products and Coupons of order.data are filled from them whenever the
+    order is sent.
     """
-    def __init__(self, store, customer, country=COUNTRY):
+    def __init__(self, store, customer, country=COUNTRY, menu=None):
         self.store = store
-        self.menu = Menu.from_store(store_id=store.id, country=country)
+        self.version = 0
+        self._priced = None
+        self._validated = None
+        self._encoded = {}
+        self._stale = set()
+        self.products = Cart()
+        self.coupons = Cart()
+        self.menu = menu or Menu.from_store(store_id=store.id, country=country)
         self.customer = customer
         self.address = customer.address
         self.urls = Urls(country)
@@ -84,34 +633,98 @@ class Order(object):
     def __repr__(self):
         return "An order for {} with {} items in it\n".format(
             self.customer.first_name,
-            len(self.data['Products']) if self.data['Products'] else 'no',
+            len(self.products) if self.products else 'no',
         )
 
-    # TODO: Implement item options
+    def changed(self, *keys):
+        """Mark the order as edited, so the next price() or validate() goes to the API.
+
+        keys are the fields of order.data that were edited in place. Only
+        cart lines edited in place ('Products', 'Coupons') need naming, as
+        they are the only fields whose encoding is kept between sends; if
+        no keys are given, they are encoded afresh too.
+        """
+        self.version += 1
+        if keys:
+            self._stale.update(keys)
+        else:
+            self._encoded.clear()
+
+    @property
+    def dirty(self):
+        """True if the cart changed since it was last priced by the API."""
+        return self._priced is None or self._priced[0] != self.version
+
     # TODO: Add exception handling for KeyErrors
     def add_item(self, code, qty=1, options=[]):
-        item = self.menu.variants[code]
-        item.update(ID=1, isNew=True, Qty=qty, AutoRemove=False)
-        self.data['Products'].append(item)
+        """Add an item by variant code, e.g. add_item('P12IPAZA', options=['X', 'C']).
+
+        See Cart.options for the forms options can take.
+        """
+        item = self.products.add(code, self.menu.variants[code], qty, options)
+        self.changed('Products')
         return item
 
-    # TODO: Raise Exception when index isn't found
-    def remove_item(self, code):
-        codes = [x['Code'] for x in self.data['Products']]
-        return self.data['Products'].pop(codes.index(code))
+    def remove_item(self, code, qty=None):
+        """Undo the last add_item of a code, or take qty of it out of the order."""
+        item = self.products.remove(code, qty)
+        self.changed('Products')
+        return item
 
     def add_coupon(self, code, qty=1):
-        item = self.menu.variants[code]
-        item.update(ID=1, isNew=True, Qty=qty, AutoRemove=False)
-        self.data['Coupons'].append(item)
-        return item
+        coupon = self.coupons.add(code, {}, qty)
+        self.changed('Coupons')
+        return coupon
 
-    def remove_coupon(self, code):
-        codes = [x['Code'] for x in self.data['Coupons']]
-        return self.data['Coupons'].pop(codes.index(code))
+    def remove_coupon(self, code, qty=None):
+        coupon = self.coupons.remove(code, qty)
+        self.changed('Coupons')
+        return coupon
 
-    def _send(self, url, merge):
+    def estimate(self):
+        """Price the cart locally from the menu's variant prices.
+
+        This is an estimate of the menu price only: it knows nothing about
+        taxes, delivery fees or coupon discounts, which only the API's
+        price() can work out.
+        """
+        items = []
+        total = 0.0
+        for product in self.products:
+            variant = self.menu.variants.get(product['Code'], {})
+            price = float(variant.get('Price') or 0)
+            amount = round(price * product.get('Qty', 1), 2)
+            items.append({'Code': product['Code'], 'Qty': product.get('Qty', 1),
+                          'Price': price, 'Amount': amount})
+            total += amount
+        return {'Items': items, 'Total': round(total, 2)}
+
+    def check(self):
+        """Validate the order locally, returning a list of problems.
+
+        Catches what can be known without the API: an empty cart, codes
+        that are not on the menu, bad quantities and a missing address.
+        """
+        problems = []
+        if not self.products:
+            problems.append('order has no products')
+        for product in self.products:
+            if product.get('Code') not in self.menu.variants:
+                problems.append('product "%s" is not on the menu' % product.get('Code'))
+            qty = product.get('Qty', 1)
+            if not isinstance(qty, int) or qty < 1:
+                problems.append('product "%s" has invalid quantity %r' % (product.get('Code'), qty))
+        if not self.store.id or self.store.id == '-1':
+            problems.append('order has no store')
+        for key in ('Street', 'City'):
+            if not self.data['Address'].get(key):
+                problems.append('address has no %s' % key)
+        return problems
+
+    def _payload(self):
         self.data.update(
+            Products=self.products.to_list(),
+            Coupons=self.coupons.to_list(),
             StoreID=self.store.id,
             Email=self.customer.email,
             FirstName=self.customer.first_name,
@@ -123,25 +736,88 @@ class Order(object):
             if key not in self.data or not self.data[key]:
                 raise Exception('order has invalid value for key "%s"' % key)
 
-        headers = {
-            'Referer': 'https://order.dominos.com/en/pages/order/',
-            'Content-Type': 'application/json'
-        }
+        return {'Order': self.data}
 
-        r = requests.post(url=url, headers=headers, json={'Order': self.data})
-        r.raise_for_status()
-        json_data = r.json()
+    def _body(self):
+        """Encode the order for the API as JSON bytes.
 
+        The Products and Coupons lists, by far the largest fields, are
+        encoded once per version of their Cart (Cart.to_list returns a new
+        list when the cart changes) and their bytes reused. Every other
+        field is small and encoded on each send, so edits made in place to
+        order.data (e.g. the Address) are always sent.
+        """
+        parts = []
+        for key, value in self._payload()['Order'].items():
+            if key not in CART_FIELDS:
+                parts.append((json.dumps(key) + ':' + json.dumps(value)).encode())
+                continue
+            cached = self._encoded.get(key)
+            if cached is None or cached[0] is not value or key in self._stale:
+                encoded = (json.dumps(key) + ':' + json.dumps(value)).encode()
+                cached = self._encoded[key] = (value, encoded)
+            parts.append(cached[1])
+        self._stale.clear()
+        return b'{"Order":{' + b','.join(parts) + b'}}'
+
+    def _merge(self, json_data, merge):
         if merge:
-            for key, value in json_data['Order'].items():
-                if value or not isinstance(value, list):
+            order = json_data['Order']
+            for key in MERGE_KEYS:
+                value = order.get(key)
+                if key in order and (value or not isinstance(value, list)):
                     self.data[key] = value
         return json_data
 
+    def _send(self, url, merge):
+        if _metrics is None:
+            r = _transport.post(url, headers=ORDER_HEADERS, data=self._body())
+            r.raise_for_status()
+            return self._merge(decode_json(r.content), merge)
+        start = time.perf_counter()
+        body = self._body()
+        sent = _record_phase('order.encode', start)
+        r = _transport.post(url, headers=ORDER_HEADERS, data=body)
+        _record_request(url, 'POST', sent, r.status_code, len(r.content), len(body))
+        r.raise_for_status()
+        response = self._merge(decode_json(r.content), merge)
+        _metrics.stage(ORDER_STAGES.get(endpoint_name(url)[1], url), time.perf_counter() - start)
+        return response
+
+    def _cached(self, result):
+        if result is not None and result[0] == self.version:
+            return result[1]
+        return None
+
+    def price(self, force=False):
+        """Price the order with the API.
+
+        The response is reused until the cart changes, unless force=True.
+        """
+        response = None if force else self._cached(self._priced)
+        if response is None:
+            version = self.version
+            response = self._send(self.urls.price_url(), True)
+            self._check_price(response)
+            self._priced = (version, response)
+        return response
+
     # TODO: Figure out if this validates anything that self.urls.price_url() does not
     def validate(self):
-        response = self._send(self.urls.validate_url(), True)
-        return response['Status'] != -1
+        """Validate the order, locally first and then with the API.
+
+        Orders that fail check() are rejected without a round trip, and the
+        API's answer is reused until the cart changes.
+        """
+        if self.check():
+            return False
+        valid = self._cached(self._validated)
+        if valid is None:
+            version = self.version
+            response = self._send(self.urls.validate_url(), True)
+            valid = response['Status'] != -1
+            self._validated = (version, valid)
+        return valid
 
     # TODO: Actually test this
     def place(self, card=False):
@@ -149,15 +825,21 @@ class Order(object):
         response = self._send(self.urls.place_url(), False)
         return response
 
-    # TODO: Add self.price() and update whenever called and items were changed
     def pay_with(self, card=False):
         """Use this instead of self.place when testing"""
-        # get the price to check that everything worked okay
-        response = self._send(self.urls.price_url(), True)
-        
+        # always get a fresh price at checkout to check that everything worked okay
+        response = self.price(force=True)
+        self._pay(response, card)
+        return response
+
+    @staticmethod
+    def _check_price(response):
         if response['Status'] == -1:
             raise Exception('get price failed: %r' % response)
 
+    def _pay(self, response, card):
+        self._check_price(response)
+
         if card == False:
             self.data['Payments'] = [
                 {
@@ -177,10 +859,425 @@ class Order(object):
                 }
             ]
 
-        return response
-		
-		
-		
+    def state(self):
+        """The order as plain data (see from_state), for an OrderQueue.
+
+        Payments are left out, so card details are never written anywhere.
+        """
+        address = self.address
+        data = dict((key, value) for key, value in self.data.items()
+                    if key not in ('Products', 'Coupons', 'Payments'))
+        return {
+            'Country': self.urls.country,
+            'StoreID': self.store.id,
+            'Customer': (self.customer.first_name, self.customer.last_name,
+                         self.customer.email, self.customer.phone),
+            'Address': (address.street, address.city, address.region, address.zip),
+            'Products': self.products.to_list(),
+            'Coupons': self.coupons.to_list(),
+            'Data': data,
+        }
+
+    @classmethod
+    def from_state(cls, state, menu=None):
+        """Rebuild an Order from state(), with its cart and order.data."""
+        country = state['Country']
+        customer = Customer(*state['Customer'], address=',')
+        customer.address = Address(*state['Address'], country=country)
+        order = cls(Store({'StoreID': state['StoreID']}, country), customer, country, menu)
+        for line in state['Products']:
+            order.products.add(line['Code'], line, line['Qty'], line.get('Options'))
+        for line in state['Coupons']:
+            order.coupons.add(line['Code'], line, line['Qty'])
+        order.data.update(state['Data'])
+        order.changed()
+        return order
+
+
+class TokenBucket(object):
+    """A thread-safe token bucket allowing rate calls per second.
+
+    Up to burst calls (default: rate) can go through at once after a quiet
+    spell; after that acquire() blocks until a token is free.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or max(1, int(rate))
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+OrderResult = namedtuple('OrderResult', ['order', 'stage', 'response', 'error'])
+
+
+class OrderPipeline(object):
+    """Price, validate and place many Orders concurrently.
+
+    Each order goes through price (with payment), validate and place in
+    turn, but up to workers orders are in flight at once. Every API call
+    waits for a token from a TokenBucket of rate calls per second, and at
+    most per_host calls run against the same API host at a time.
+
+    run() yields an OrderResult for each order as soon as it finishes:
+    stage is the last stage reached, and error is the exception that
+    stopped the order, or None. With place=False orders are only priced
+    and validated.
+    """
+    STAGES = ('price', 'validate', 'place')
+
+    def __init__(self, workers=16, per_host=4, rate=10, burst=None, place=True):
+        self.workers = workers
+        self.per_host = per_host
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.place = place
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return "OrderPipeline with {} workers".format(self.workers)
+
+    def host_limit(self, url):
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = threading.BoundedSemaphore(self.per_host)
+            return self.hosts[host]
+
+    def call(self, url, send, *args):
+        if self.bucket is not None:
+            self.bucket.acquire()
+        with self.host_limit(url):
+            return send(*args)
+
+    def process(self, order, card, record=None):
+        """Take one order through its stages.
+
+        record, if given, is called with the order and 'priced',
+        'validated', 'placing' and 'placed' as the order gets there, e.g.
+        by OrderQueue to log each stage.
+        """
+        stage, response = None, None
+        try:
+            stage = 'price'
+            response = self.call(order.urls.price_url(), order.pay_with, card)
+            if record is not None:
+                record(order, 'priced')
+            stage = 'validate'
+            if not self.call(order.urls.validate_url(), order.validate):
+                raise Exception('order failed validation: %r' % order.check())
+            if record is not None:
+                record(order, 'validated')
+            if self.place:
+                stage = 'place'
+                if record is not None:
+                    record(order, 'placing')
+                response = self.call(order.urls.place_url(), order._send, order.urls.place_url(), False)
+                if record is not None:
+                    record(order, 'placed')
+        except Exception as e:
+            return OrderResult(order, stage, response, e)
+        return OrderResult(order, stage, response, None)
+
+    def run(self, orders, card=False, record=None):
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(self.process, order, card, record) for order in orders]
+            for future in as_completed(futures):
+                yield future.result()
+
+
+def place_orders(orders, card=False, **kwargs):
+    """Place many Orders concurrently, yielding an OrderResult for each.
+
+    The keyword arguments configure the OrderPipeline.
+    """
+    return OrderPipeline(**kwargs).run(orders, card)
+
+
+# An OrderQueue record: payload length and CRC32, then the record as JSON
+_RECORD_HEADER = struct.Struct('<II')
+
+
+def _encode_record(record):
+    payload = json.dumps(record, separators=(',', ':')).encode()
+    return _RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def _fsync_directory(path):
+    """Make a file created or renamed in path's directory survive a crash."""
+    if os.name == 'nt':
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# Stages after which an order is not sent again by OrderQueue.run
+QUEUE_DONE = ('placing', 'placed', 'failed')
+
+
+class OrderQueue(object):
+    """A durable intake queue for Orders, backed by a write-ahead log.
+
+    put() appends the order's state (see Order.state) to the log at path
+    and returns its key once the record is on disk. run() takes the
+    orders through an OrderPipeline and logs each stage they reach:
+    queued, priced, validated, placing, placed or failed. Opening the
+    queue again after a crash reads the log back, so run() resumes the
+    orders that were not finished, and never sends again an order that
+    got to 'placing': it may or may not have been placed, see in_doubt().
+
+    Writes are group-committed: a single writer thread appends every
+    record waiting for it and fsyncs once for all of them, so many
+    threads putting orders at once share each fsync. With sync=False
+    records are flushed but not fsynced.
+
+    Records are JSON, so the log can be read back by any Python version
+    after an upgrade, and keys must be strings.
+    """
+    def __init__(self, path, batch_size=1024, sync=True):
+        self.path = path
+        self.batch_size = batch_size
+        self.sync = sync
+        self.orders = OrderedDict()
+        self.lock = threading.Lock()
+        self.file_lock = threading.Lock()
+        self.waiting = queue.Queue()
+        self.records = self.fsyncs = 0
+        self.error = None
+        self.closed = False
+        self.replay()
+        created = not os.path.exists(path)
+        self.file = open(path, 'ab')
+        if created and sync:
+            _fsync_directory(path)
+        self.writer = threading.Thread(target=self.write_batches, daemon=True)
+        self.writer.start()
+
+    def __repr__(self):
+        return "OrderQueue of {} orders at {}".format(len(self.orders), self.path)
+
+    def __len__(self):
+        return len(self.orders)
+
+    def __contains__(self, key):
+        return key in self.orders
+
+    def replay(self):
+        """Load the log, cutting off a record left half-written by a crash."""
+        try:
+            with open(self.path, 'rb') as f:
+                content = f.read()
+        except FileNotFoundError:
+            return
+        offset = 0
+        while offset + _RECORD_HEADER.size <= len(content):
+            length, crc = _RECORD_HEADER.unpack_from(content, offset)
+            start = offset + _RECORD_HEADER.size
+            payload = content[start:start + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+            self.apply(*json.loads(payload))
+            offset = start + length
+        if offset < len(content):
+            with open(self.path, 'r+b') as f:
+                f.truncate(offset)
+
+    def apply(self, key, stage, state, error):
+        entry = self.orders.get(key)
+        if entry is None:
+            entry = self.orders[key] = [stage, state, error]
+        else:
+            entry[0] = stage
+            entry[1] = state if state is not None else entry[1]
+            entry[2] = error
+
+    def write_batches(self):
+        while True:
+            batch = [self.waiting.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.waiting.get_nowait())
+                except queue.Empty:
+                    break
+            closing = batch[-1] is None
+            if closing:
+                batch.pop()
+            try:
+                with self.file_lock:
+                    self.file.write(b''.join(record for record, _ in batch))
+                    self.file.flush()
+                    if self.sync:
+                        os.fsync(self.file.fileno())
+                self.records += len(batch)
+                self.fsyncs += 1
+            except Exception as e:
+                self.error = e
+            for _, done in batch:
+                done.set()
+            if closing:
+                return
+
+    def write(self, key, stage, state=None, error=None, wait=True, new=False):
+        """Log a stage of an order; with wait=True, return once it is on disk.
+
+        With new=True nothing is logged if key is already in the queue; the
+        check and the write are one step, so two writers cannot both add it.
+        """
+        if self.error is not None:
+            raise Exception('order queue log failed: %r' % self.error)
+        record = _encode_record((key, stage, state, error))
+        done = threading.Event()
+        with self.lock:
+            if self.closed:
+                raise Exception('order queue is closed')
+            if new and key in self.orders:
+                return key
+            self.apply(key, stage, state, error)
+            self.waiting.put((record, done))
+        if wait:
+            done.wait()
+            if self.error is not None:
+                raise Exception('order queue log failed: %r' % self.error)
+        return key
+
+    def put(self, order, key=None, wait=True):
+        """Add an order to the queue durably and return its key.
+
+        Putting a key that is already in the queue does nothing, so
+        retried intakes with the same key are only ever queued once.
+        """
+        if key is None:
+            import uuid
+            key = uuid.uuid4().hex
+        return self.write(key, 'queued', order.state(), wait=wait, new=True)
+
+    def stage(self, key):
+        return self.orders[key][0]
+
+    def order(self, key, menu=None):
+        """Rebuild a queued order from its last logged state."""
+        return Order.from_state(self.orders[key][1], menu)
+
+    def keys(self, *stages):
+        with self.lock:
+            return [key for key, entry in self.orders.items() if entry[0] in stages]
+
+    def pending(self):
+        """Keys of the orders run() would still send."""
+        with self.lock:
+            return [key for key, entry in self.orders.items() if entry[0] not in QUEUE_DONE]
+
+    def in_doubt(self):
+        """Keys of orders whose place call started but was never logged as done.
+
+        Check these with the store (e.g. track_by_phone) before placing
+        them again with retry().
+        """
+        return self.keys('placing')
+
+    def failed(self):
+        return self.keys('failed')
+
+    def retry(self, key):
+        """Queue a failed or in-doubt order to be sent again by run()."""
+        return self.write(key, 'queued')
+
+    def run(self, card=False, pipeline=None, menus=None, **kwargs):
+        """Send every pending order through an OrderPipeline, logging each stage.
+
+        menus is an optional dict of store id to Menu (see load_menus);
+        the keyword arguments configure the OrderPipeline. Yields an
+        OrderResult per order, like OrderPipeline.run.
+        """
+        pipeline = pipeline or OrderPipeline(**kwargs)
+        menus = menus or {}
+        keys = {}
+        orders = []
+        for key in self.pending():
+            try:
+                state = self.orders[key][1]
+                order = Order.from_state(state, menus.get(state['StoreID']))
+            except Exception as e:
+                self.write(key, 'failed', error=repr(e))
+                yield OrderResult(None, None, None, e)
+                continue
+            keys[id(order)] = key
+            orders.append(order)
+
+        def record(order, stage):
+            self.write(keys[id(order)], stage, order.state() if stage != 'placing' else None)
+
+        for result in pipeline.run(orders, card, record):
+            if result.error is not None and result.stage != 'place':
+                self.write(keys[id(result.order)], 'failed', error=repr(result.error))
+            yield result
+
+    def compact(self):
+        """Rewrite the log with only the last record of each order.
+
+        Placed orders lose their state but keep a small record of their
+        key, so putting the same key again still does nothing.
+        """
+        with self.lock, self.file_lock:
+            temp = '{}.{}.tmp'.format(self.path, threading.get_ident())
+            with open(temp, 'wb') as f:
+                for key, entry in self.orders.items():
+                    if entry[0] == 'placed':
+                        entry[1] = entry[2] = None
+                    f.write(_encode_record((key,) + tuple(entry)))
+                f.flush()
+                os.fsync(f.fileno())
+            self.file.close()
+            os.replace(temp, self.path)
+            _fsync_directory(self.path)
+            self.file = open(self.path, 'ab')
+
+    def stats(self):
+        stats = {'records': self.records, 'fsyncs': self.fsyncs}
+        with self.lock:
+            for stage, _, _ in self.orders.values():
+                stats[stage] = stats.get(stage, 0) + 1
+        return stats
+
+    def close(self):
+        """Write out every record still waiting and close the log."""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.waiting.put(None)
+        self.writer.join()
+        self.file.close()
+
+
+def load_menus(stores, lang='en', workers=8):
+    """Fetch the menus of many Stores concurrently, one download per store.
+
+    Returns a dict of store id to Menu, for passing to Order(menu=...).
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    unique = dict((store.id, store) for store in stores)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        menus = executor.map(lambda store: store.get_menu(lang), unique.values())
+        return dict(zip(unique, menus))
+
+
+
 
 class Address(object):
     """Create an address, for finding stores and placing orders.
@@ -222,16 +1319,14 @@ class Address(object):
     def line2(self):
         return '{City}, {Region}, {PostalCode}'.format(**self.data)
 
-    def nearby_stores(self, service='Delivery'):
+    def nearby_stores(self, service='Delivery', cache=True):
         """Query the API to find nearby stores.
 
         nearby_stores will filter the information we receive from the API
         to exclude stores that are not currently online (!['IsOnlineNow']),
         and stores that are not currently in service (!['ServiceIsOpen']).
         """
-        data = request_json(self.urls.find_url(), line1=self.line1, line2=self.line2, type=service)
-        return [Store(x, self.country) for x in data['Stores']
-                if x['IsOnlineNow'] and x['ServiceIsOpen'][service]]
+        return StoreLocator.nearby_stores(self, service=service, cache=cache)
 
     def closest_store(self, service='Delivery'):
         stores = self.nearby_stores(service=service)
@@ -240,19 +1335,38 @@ class Address(object):
         return stores[0]
 
 class Coupon(object):
-    """Loose representation of a coupon - no logic. 
+    """Loose representation of a coupon. 
 
-    This is a coupon - you can add it to an Order (order.add_item) and,
+    This is a coupon - you can add it to an Order (order.add_coupon) and,
     if it fits, get some money off your purchase. I think. 
 
     This is another thing that's worth exploring - there are some sweet 
     coupons that would be awful without the coupon. 
+
+    Coupons built from the API (from_data) also know their price and their
+    product groups: each group is a required quantity and the product or
+    variant codes that can fill it. The CouponCatalog uses these to work
+    out locally which coupons fit an order.
     """
-    def __init__(self, code, quantity=1):
+    def __init__(self, code, quantity=1, name='', price=None, groups=()):
         self.code = code
         self.quantity = quantity
         self.id = 1
         self.is_new = True
+        self.name = name
+        self.price = price
+        self.groups = groups
+
+    def __repr__(self):
+        return "Coupon {} {}".format(self.code, self.name).strip()
+
+    @classmethod
+    def from_data(cls, data):
+        groups = tuple((int(group.get('RequiredQty', 1)), frozenset(group.get('ProductCodes', ())))
+                       for group in data.get('ProductGroups') or ())
+        price = data.get('Price')
+        return cls(data['Code'], name=data.get('Name', ''),
+                   price=float(price) if price not in (None, '') else None, groups=groups)
 
 
 class Customer:
@@ -280,28 +1394,85 @@ class Customer:
 
 # TODO: Get rid of this class
 class MenuCategory(object):
-    def __init__(self, menu_data={}, parent=None):
-        self.menu_data = menu_data
+    __slots__ = ('code', 'name', 'parent', 'subcategories', 'products', 'menu_data', 'path')
+
+    def __init__(self, menu_data={}, parent=None, keep_raw=True):
+        self.menu_data = menu_data if keep_raw else None
         self.subcategories = []
         self.products = []
         self.parent = parent
-        self.code = menu_data['Code']
+        self.code = sys.intern(menu_data['Code'])
         self.name = menu_data['Name']
+        self.path = self.code if parent is None else parent.path + self.code
 
     def get_category_path(self):
-        path = '' if not self.parent else self.parent.get_category_path()
-        return path + self.code
+        return self.path
 
 
 # TODO: Get rid of this class
 class MenuItem(object):
-    def __init__(self, data={}):
-        self.code = data['Code']
+    __slots__ = ('code', 'name', 'menu_data', 'categories')
+
+    def __init__(self, data={}, keep_raw=True):
+        self.code = sys.intern(data['Code'])
         self.name = data['Name']
-        self.menu_data = data
+        self.menu_data = data if keep_raw else None
         self.categories = []
 
 
+# Variant fields whose values repeat within a menu and across menus
+INTERNED_FIELDS = ('Code', 'ProductCode', 'SizeCode', 'FlavorCode')
+
+
+def compact_variants(variants):
+    """Shrink a menu's variant table in place.
+
+    Repeated strings (codes, sizes, flavors, tag keys and values) are
+    interned, so every cached menu shares one copy of each, and variants
+    with identical Tags share a single dict.
+    """
+    intern = sys.intern
+    shared_tags = {}
+    for variant in variants.values():
+        for field in INTERNED_FIELDS:
+            value = variant.get(field)
+            if isinstance(value, str):
+                variant[field] = intern(value)
+        tags = variant.get('Tags')
+        if not isinstance(tags, dict):
+            continue
+        try:
+            key = tuple(sorted(tags.items()))
+            hash(key)
+        except TypeError:
+            continue
+        if key not in shared_tags:
+            shared_tags[key] = {intern(k): intern(v) if isinstance(v, str) else v
+                                for k, v in tags.items()}
+        variant['Tags'] = shared_tags[key]
+    return variants
+
+
+_menu_lock = threading.RLock()
+
+# Sections of a menu response that become MenuItems
+ITEM_SECTIONS = ('Products', 'Coupons', 'PreconfiguredProducts')
+
+# Sections of a menu response Menu.update diffs
+MENU_SECTIONS = ITEM_SECTIONS + ('Categorization',)
+
+# What Menu.update changed: codes of variants and items, and root categories
+MenuChanges = namedtuple('MenuChanges', ['added', 'removed', 'changed', 'categories'])
+
+
+def fingerprints(data):
+    """A hash of the canonical JSON of every item and root category of a
+    menu response, by section, to tell which ones a newer response changed."""
+    dumps = json.JSONEncoder(sort_keys=True, separators=(',', ':')).encode
+    return dict((section, dict((code, hash(dumps(value))) for code, value in data.get(section, {}).items()))
+                for section in MENU_SECTIONS)
+
+
 class Menu(object):
     """The Menu is our primary interface with the API. 
 
@@ -310,36 +1481,259 @@ class Menu(object):
 
     Next time I get pizza, there is a lot of work to be done in 
     documenting this class.
+
+    With lazy=True only the variants table is ready straight away, which is
+    all add_item needs. The products, coupons and category tree are built
+    the first time one of them is used (or when materialize() is called).
+
+    compact=True shrinks the variants table (see compact_variants), and
+    MenuItems and MenuCategories only hold on to their raw dicts
+    (menu_data) when keep_raw=True.
+
+    Menus loaded from a store remember it and the response's ETag and
+    Last-Modified, so refresh() can patch them in place (see update())
+    and costs a 304 when nothing has changed. To diff against, a
+    materialized menu keeps a fingerprint of each item and root category
+    (see fingerprints), or the raw sections when keep_raw=True.
     """
-    def __init__(self, data={}, country=COUNTRY):
+    def __init__(self, data={}, country=COUNTRY, lazy=False, compact=False, keep_raw=False):
         self.variants = data.get('Variants', {})
-        self.menu_by_code = {}
-        self.root_categories = {}
-        self.country = COUNTRY
+        if compact:
+            start = time.perf_counter() if _metrics is not None else None
+            compact_variants(self.variants)
+            if start is not None:
+                _record_phase('menu.compact', start)
+        self.country = country
+        self.compact = compact
+        self.keep_raw = keep_raw
+        self.store_id = self.lang = None
+        self.etag = self.last_modified = None
+        self._index = None
+        self._tree = None
+        self._data = data if self.variants else None
+        self._sections = {}
+        self._menu_by_code = {}
+        self._root_categories = {}
+        self._products = []
+        self._coupons = []
+        self._preconfigured = []
+        if not lazy:
+            self.materialize()
+
+    def materialize(self):
+        """Build the products, coupons and category tree, if not done yet."""
+        if self._data is not None:
+            with _menu_lock:
+                data = self._data
+                if data is not None:
+                    start = time.perf_counter() if _metrics is not None else None
+                    self._products = self.parse_items(data['Products'])
+                    self._coupons = self.parse_items(data['Coupons'])
+                    self._preconfigured = self.parse_items(data['PreconfiguredProducts'])
+                    if start is not None:
+                        start = _record_phase('menu.items', start)
+                    for key, value in data['Categorization'].items():
+                        self._root_categories[key] = self.build_categories(value)
+                    if start is not None:
+                        _record_phase('menu.categories', start)
+                    self._sections = self.sections(data)
+                    self._data = None
+        return self
+
+    @property
+    def menu_by_code(self):
+        if self._data is not None:
+            self.materialize()
+        return self._menu_by_code
+
+    @property
+    def root_categories(self):
+        if self._data is not None:
+            self.materialize()
+        return self._root_categories
 
-        if self.variants:
-            self.products = self.parse_items(data['Products'])
-            self.coupons = self.parse_items(data['Coupons'])
-            self.preconfigured = self.parse_items(data['PreconfiguredProducts'])
-            for key, value in data['Categorization'].items():
-                self.root_categories[key] = self.build_categories(value)
+    @property
+    def products(self):
+        if self._data is not None:
+            self.materialize()
+        return self._products
+
+    @property
+    def coupons(self):
+        if self._data is not None:
+            self.materialize()
+        return self._coupons
+
+    @property
+    def preconfigured(self):
+        if self._data is not None:
+            self.materialize()
+        return self._preconfigured
+
+    @classmethod
+    def from_json(cls, content, country=COUNTRY, **kwargs):
+        """Build a Menu from a raw menu response body (bytes or str)."""
+        return cls(decode_json(content), country, **kwargs)
 
     @classmethod
-    def from_store(cls, store_id, lang='en', country=COUNTRY):
-        response = request_json(Urls(country).menu_url(), store_id=store_id, lang=lang)
-        menu = cls(response)
+    def from_store(cls, store_id, lang='en', country=COUNTRY, cache=True, lazy=False):
+        """Get a store's Menu, from the menu cache if it has a fresh copy.
+
+        Pass cache=False to always download and parse a new Menu. Cached
+        menus are lazy or not depending on the MenuCache.
+        """
+        if cache and _menu_cache is not None:
+            return _menu_cache.get_menu(store_id, lang, country)
+        response, etag, last_modified = request_json_if_modified(
+            Urls(country).menu_url(), store_id=store_id, lang=lang)
+        menu = cls(response, country, lazy)
+        menu.store_id, menu.lang = str(store_id), lang
+        menu.etag, menu.last_modified = etag, last_modified
         return menu
 
+    @classmethod
+    async def async_from_store(cls, store_id, lang='en', country=COUNTRY, cache=True, lazy=False):
+        if cache and _menu_cache is not None:
+            return await _menu_cache.async_get_menu(store_id, lang, country)
+        response = await async_request_json(Urls(country).menu_url(), store_id=store_id, lang=lang)
+        menu = cls(response, country, lazy)
+        menu.store_id, menu.lang = str(store_id), lang
+        return menu
+
+    def refresh(self):
+        """Bring a menu loaded from a store up to date, in place.
+
+        Asks the store for its menu only if it changed since this one was
+        downloaded, and then patches this menu with update(). Returns the
+        MenuChanges, all empty if the menu was not modified.
+        """
+        if self.store_id is None:
+            raise Exception('Menu was not loaded from a store')
+        response, etag, last_modified = request_json_if_modified(
+            Urls(self.country).menu_url(), self.etag, self.last_modified,
+            store_id=self.store_id, lang=self.lang)
+        if response is None:
+            return MenuChanges(set(), set(), set(), set())
+        return self.update(response, etag, last_modified)
+
+    def update(self, data, etag=None, last_modified=None):
+        """Patch the menu in place to match a newer menu response.
+
+        The variants table, menu_by_code and the category tree are diffed
+        against data: only variants and items that changed are replaced
+        (MenuItems are updated rather than replaced, so the category tree
+        still points at them) and only root categories whose structure
+        changed are rebuilt. Items and categories are diffed on their raw
+        data (or its fingerprints, see sections()), so a materialized menu
+        reports the same changes as one that was not materialized yet,
+        which just takes the new data. Returns the MenuChanges.
+        """
+        start = time.perf_counter() if _metrics is not None else None
+        added, removed, changed, categories = set(), set(), set(), set()
+        variants = data.get('Variants', {})
+        if self.compact:
+            compact_variants(variants)
+        with _menu_lock:
+            for code in [code for code in self.variants if code not in variants]:
+                del self.variants[code]
+                removed.add(code)
+            for code, variant in variants.items():
+                old = self.variants.get(code)
+                if old == variant:
+                    continue
+                (added if old is None else changed).add(code)
+                self.variants[code] = variant
+            if added or removed or changed:
+                self._index = None
+            self._tree = None
+            if self._data is not None:
+                old, new = self._data, data
+            else:
+                old, new = self._sections, self.sections(data)
+            diffs = {}
+            for section in ITEM_SECTIONS:
+                diffs[section] = (set(), set(), set())
+                self.diff_data(old.get(section, {}), new.get(section, {}), *diffs[section])
+                added |= diffs[section][0]
+                removed |= diffs[section][1]
+                changed |= diffs[section][2]
+            old_roots = old.get('Categorization', {})
+            new_roots = new.get('Categorization', {})
+            categories.update(key for key in set(old_roots) | set(new_roots)
+                              if old_roots.get(key) != new_roots.get(key))
+            if self._data is not None:
+                self._data = data
+            else:
+                self._products = self.update_items(
+                    self._products, data.get('Products', {}), *diffs['Products'])
+                self._coupons = self.update_items(
+                    self._coupons, data.get('Coupons', {}), *diffs['Coupons'])
+                self._preconfigured = self.update_items(
+                    self._preconfigured, data.get('PreconfiguredProducts', {}),
+                    *diffs['PreconfiguredProducts'])
+                for key in categories:
+                    old_root = self._root_categories.pop(key, None)
+                    if old_root is not None:
+                        self.detach(old_root)
+                    if key in new_roots:
+                        self._root_categories[key] = self.build_categories(data['Categorization'][key])
+                self._sections = new
+            self.etag, self.last_modified = etag, last_modified
+        if start is not None:
+            _record_phase('menu.update', start)
+        return MenuChanges(added, removed, changed, categories)
+
+    def sections(self, data):
+        """What update() diffs a materialized menu against (see fingerprints)."""
+        if self.keep_raw:
+            return dict((key, data.get(key, {})) for key in MENU_SECTIONS)
+        return fingerprints(data)
+
+    @staticmethod
+    def diff_data(old, new, added, removed, changed):
+        for code in old:
+            if code not in new:
+                removed.add(code)
+            elif old[code] != new[code]:
+                changed.add(code)
+        added.update(code for code in new if code not in old)
+
+    def update_items(self, items, item_data, added, removed, changed):
+        """Apply the diff of one section of items (see diff_data) to its MenuItems."""
+        kept = []
+        for item in items:
+            if item.code in removed:
+                self._menu_by_code.pop(item.code, None)
+                for category in item.categories:
+                    category.products.remove(item)
+                continue
+            if item.code in changed:
+                new = MenuItem(item_data[item.code], self.keep_raw)
+                item.name, item.menu_data = new.name, new.menu_data
+            kept.append(item)
+        for code in [code for code in item_data if code in added]:
+            item = MenuItem(item_data[code], self.keep_raw)
+            self._menu_by_code[item.code] = item
+            kept.append(item)
+        return kept
+
+    def detach(self, category):
+        """Unlink a category tree that is being replaced from its products."""
+        for subcategory in category.subcategories:
+            self.detach(subcategory)
+        for product in category.products:
+            product.categories.remove(category)
+
     # TODO: Reconfigure structure to show that Codes (not ProductCodes) matter
     def build_categories(self, category_data, parent=None):
-        category = MenuCategory(category_data, parent)
+        category = MenuCategory(category_data, parent, self.keep_raw)
         for subcategory in category_data['Categories']:
             new_subcategory = self.build_categories(subcategory, category)
             category.subcategories.append(new_subcategory)
         for product_code in category_data['Products']:
-            if product_code not in self.menu_by_code:
+            if product_code not in self._menu_by_code:
                 raise Exception('PRODUCT NOT FOUND: %s %s' % (product_code, category.code))
-            product = self.menu_by_code[product_code]
+            product = self._menu_by_code[product_code]
             category.products.append(product)
             product.categories.append(category)
         return category
@@ -347,44 +1741,915 @@ class Menu(object):
     def parse_items(self, parent_data):
         items = []
         for code in parent_data.keys():
-            obj = MenuItem(parent_data[code])
-            self.menu_by_code[obj.code] = obj
+            obj = MenuItem(parent_data[code], self.keep_raw)
+            self._menu_by_code[obj.code] = obj
             items.append(obj)
         return items
 
     # TODO: Print codes that can actually be used to order items
     def display(self):
-        def print_category(category, depth=1):
-            indent = "  " * (depth + 1)
-            if len(category.products) + len(category.subcategories) > 0:
-                print(indent + category.name)
-                for subcategory in category.subcategories:
-                    print_category(subcategory, depth + 1)
-                for product in category.products:
-                    print(indent + "  [%s]" % product.code, product.name)
-        print("************ Coupon Menu ************")
-        print_category(self.root_categories['Coupons'])
-        print("\n************ Preconfigured Menu ************")
-        print_category(self.root_categories['PreconfiguredProducts'])
-        print("\n************ Regular Menu ************")
-        print_category(self.root_categories['Food'])
-
-    # TODO: Find more pythonic way to format the menu
-    # TODO: Format the menu after the variants have been filtered
-    # TODO: Return the search results and print in different method
-    # TODO: Import fuzzy search module or allow lists as search conditions
-    def search(self, **conditions):
-        max_len = lambda x: 2 + max(len(v[x]) for v in list(self.variants.values()))
-        for v in self.variants.values():
-            v['Toppings'] = dict(x.split('=', 1) for x in v['Tags']['DefaultToppings'].split(',') if x)
-            if all(y in v.get(x, '') for x, y in conditions.items()):
-                print(v['Code'], end=' ')
-                print(v['Name'], end=' ')
-                print('$' + v['Price'])
-                #print(v['SizeCode'], end=' ')
-                #print(v['ProductCode'], end=' ')
-                #print(v['Toppings'])
+        for line in self.render():
+            print(line)
+
+    def render(self):
+        """The lines display() prints, one at a time, for paging through a menu."""
+        yield "************ Coupon Menu ************"
+        yield from self.tree.lines('Coupons')
+        yield "\n************ Preconfigured Menu ************"
+        yield from self.tree.lines('PreconfiguredProducts')
+        yield "\n************ Regular Menu ************"
+        yield from self.tree.lines('Food')
+
+    @property
+    def tree(self):
+        """The CategoryTree of the menu, built on first use.
+
+        Like index, it is built under the menu lock, so not while update()
+        is changing the menu, and update() replaces it rather than changing
+        it, so a tree already in use stays consistent.
+        """
+        tree = self._tree
+        if tree is None:
+            with _menu_lock:
+                if self._tree is None:
+                    start = time.perf_counter() if _metrics is not None else None
+                    self._tree = CategoryTree(self.root_categories)
+                    if start is not None:
+                        _record_phase('menu.tree', start)
+                tree = self._tree
+        return tree
+
+    @property
+    def index(self):
+        index = self._index
+        if index is None:
+            with _menu_lock:
+                if self._index is None:
+                    start = time.perf_counter() if _metrics is not None else None
+                    self._index = MenuIndex(self.variants)
+                    if start is not None:
+                        _record_phase('menu.index', start)
+                index = self._index
+        return index
+
+    def search(self, fuzzy=False, **conditions):
+        """Find the variants matching every condition, in menu order.
+
+        Conditions are matched through the MenuIndex: Name by words (case
+        insensitive, each word of the query may be the start of a word in
+        the name), Code, ProductCode and SizeCode exactly, and Toppings by
+        topping code. Any other field matches if the value is a substring
+        of it. A list of values matches any of them, e.g.
+        menu.search(Name='Coke', SizeCode=['12', '14']).
+
+        With fuzzy=True, words of the Name are also matched against
+        similarly spelled words on the menu.
+        """
+        return self.index.search(fuzzy=fuzzy, **conditions)
+
+    @staticmethod
+    def print_results(results):
+        """Print search results as aligned columns of code, name and price."""
+        if not results:
+            return
+        code_len = max(len(v['Code']) for v in results) + 2
+        name_len = max(len(v['Name']) for v in results) + 2
+        for v in results:
+            print(v['Code'].ljust(code_len) + v['Name'].ljust(name_len) + '$' + v['Price'])
+
+
+class MenuIndex(object):
+    """Inverted indexes over a Menu's variants, used by Menu.search.
+
+    Built once per Menu, on the first search. Words of the Name, exact
+    Code, ProductCode and SizeCode values and topping codes each map to
+    the set of variant codes that have them, so a search only looks at
+    the variants that can match instead of scanning the whole menu.
+
+    The index keeps its own list of the variants, so searches that are
+    still using it after Menu.update() changed the menu see the variants
+    it was built from.
+    """
+    EXACT_FIELDS = ('Code', 'ProductCode', 'SizeCode')
+    WORD = re.compile(r'\w+')
+
+    def __init__(self, variants):
+        self.variants = list(variants.values())
+        self.order = {}
+        self.words = {}
+        self.fields = dict((field, {}) for field in self.EXACT_FIELDS)
+        self.toppings = {}
+        self.variant_toppings = {}
+        for i, (code, v) in enumerate(variants.items()):
+            self.order[code] = i
+            for word in self.WORD.findall(v.get('Name', '').lower()):
+                self.words.setdefault(word, set()).add(code)
+            for field in self.EXACT_FIELDS:
+                if field in v:
+                    self.fields[field].setdefault(v[field], set()).add(code)
+            toppings = self.parse_toppings(v)
+            self.variant_toppings[code] = toppings
+            for topping in toppings:
+                self.toppings.setdefault(topping, set()).add(code)
+        self.vocabulary = sorted(self.words)
+
+    def __repr__(self):
+        return "MenuIndex of {} variants and {} words".format(len(self.order), len(self.vocabulary))
+
+    @staticmethod
+    def parse_toppings(variant):
+        toppings = variant.get('Tags', {}).get('DefaultToppings', '')
+        return dict(x.split('=', 1) for x in toppings.split(',') if x)
+
+    def prefixed(self, prefix):
+        start = bisect.bisect_left(self.vocabulary, prefix)
+        end = bisect.bisect_left(self.vocabulary, prefix + '\U0010ffff')
+        return self.vocabulary[start:end]
+
+    def match_name(self, query, fuzzy=False):
+        codes = None
+        for word in self.WORD.findall(query.lower()):
+            words = self.prefixed(word)
+            if fuzzy:
+                import difflib
+                words += difflib.get_close_matches(word, self.vocabulary, n=5, cutoff=0.75)
+            matches = set()
+            for w in words:
+                matches |= self.words[w]
+            codes = matches if codes is None else codes & matches
+            if not codes:
+                break
+        return codes if codes is not None else set(self.order)
+
+    def match(self, field, value, fuzzy=False):
+        if field == 'Name':
+            return self.match_name(value, fuzzy)
+        if field in self.fields:
+            return self.fields[field].get(value, set())
+        if field == 'Toppings':
+            return self.toppings.get(value, set())
+        return None
+
+    def search(self, fuzzy=False, **conditions):
+        candidates = None
+        unindexed = []
+        for field, value in conditions.items():
+            values = value if isinstance(value, (list, tuple, set, frozenset)) else [value]
+            matches = set()
+            for v in values:
+                codes = self.match(field, v, fuzzy)
+                if codes is None:
+                    unindexed.append((field, values))
+                    matches = None
+                    break
+                matches |= codes
+            if matches is not None:
+                candidates = matches if candidates is None else candidates & matches
+        if candidates is None:
+            candidates = self.order
+        results = []
+        for code in sorted(candidates, key=self.order.__getitem__):
+            v = self.variants[self.order[code]]
+            if all(any(y in v.get(x, '') for y in values) for x, values in unindexed):
+                results.append(v)
+        return results
+
+
+class CategoryTree(object):
+    """A Menu's category tree, flattened into arrays in pre-order.
+
+    Built once per Menu, the first time it is needed. Category i's
+    subtree is categories[i:ends[i]], so whether one category is inside
+    another is a comparison, and the products under a category are a
+    slice away instead of a walk down the tree. by_product maps product
+    codes straight to the positions of the categories they are in.
+    """
+    def __init__(self, root_categories):
+        self.categories = []
+        self.depths = []
+        self.ends = []
+        self.roots = {}
+        self.positions = {}
+        self.by_product = {}
+        for key, root in root_categories.items():
+            self.roots[key] = len(self.categories)
+            self.add(root, 0)
+
+    def __repr__(self):
+        return "CategoryTree of {} categories".format(len(self.categories))
+
+    def __len__(self):
+        return len(self.categories)
+
+    def add(self, root, depth):
+        stack = [(root, depth)]
+        while stack:
+            category, depth = stack.pop()
+            if category is None:
+                # The end of the subtree of the category at position depth
+                self.ends[depth] = len(self.categories)
+                continue
+            i = len(self.categories)
+            self.categories.append(category)
+            self.depths.append(depth)
+            self.ends.append(None)
+            self.positions.setdefault(category.code, i)
+            for product in category.products:
+                self.by_product.setdefault(product.code, []).append(i)
+            stack.append((None, i))
+            stack.extend((sub, depth + 1) for sub in reversed(category.subcategories))
+
+    def position(self, category):
+        return category if isinstance(category, int) else self.positions[
+            category if isinstance(category, str) else category.code]
+
+    def contains(self, ancestor, category):
+        """Whether category is ancestor or one of its subcategories."""
+        i, j = self.position(ancestor), self.position(category)
+        return i <= j < self.ends[i]
+
+    def subtree(self, category):
+        i = self.position(category)
+        return self.categories[i:self.ends[i]]
+
+    def products_under(self, category):
+        """The products of a category and all of its subcategories, once each."""
+        seen = {}
+        for sub in self.subtree(category):
+            for product in sub.products:
+                seen.setdefault(product.code, product)
+        return list(seen.values())
+
+    def categories_of(self, product_code):
+        """The categories a product is in."""
+        return [self.categories[i] for i in self.by_product.get(product_code, ())]
+
+    def path(self, category):
+        return self.categories[self.position(category)].path
+
+    def lines(self, root):
+        """Display lines of a root category: each category's name, then its
+        subcategories, then its products, indented by depth."""
+        start = self.roots[root]
+        indents = {}
+        open_categories = []
+        for i in range(start, self.ends[start]):
+            while open_categories and self.ends[open_categories[-1]] <= i:
+                yield from self.product_lines(open_categories.pop(), indents)
+            category = self.categories[i]
+            if category.products or category.subcategories:
+                yield self.indent(i, indents) + category.name
+            open_categories.append(i)
+        while open_categories:
+            yield from self.product_lines(open_categories.pop(), indents)
+
+    def indent(self, i, indents):
+        depth = self.depths[i]
+        if depth not in indents:
+            indents[depth] = "  " * (depth + 2)
+        return indents[depth]
+
+    def product_lines(self, i, indents):
+        indent = self.indent(i, indents) + "  "
+        for product in self.categories[i].products:
+            yield "%s[%s] %s" % (indent, product.code, product.name)
+
+
+class TTLCache(object):
+    """A size-bounded LRU cache whose entries expire after ttl seconds.
+
+    Safe to share between threads. Hits, misses and evictions (both LRU
+    evictions and expiries) are counted, see stats().
+    """
+    def __init__(self, maxsize=128, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = self.misses = self.evictions = 0
+
+    def __repr__(self):
+        return "{} with {} of {} entries".format(
+            type(self).__name__, len(self.entries), self.maxsize)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _lookup(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.time():
+            del self.entries[key]
+            self.evictions += 1
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self._lookup(key)
+            if value is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'size': len(self.entries)}
+
+
+class MenuCache(TTLCache):
+    """Parsed Menus keyed by (country, store_id, lang).
+
+    Menu.from_store and Store.get_menu go through the module's MenuCache,
+    so a store's menu is only downloaded and parsed once per ttl. Concurrent
+    misses for the same menu wait for a single download.
+
+    If path is a directory, the raw menu JSON is also written there, so a
+    restarted process can rebuild menus that are still fresh (younger than
+    ttl) without downloading them again. A MenuStore written by warm_menus
+    can be given as store, and is looked at before path and the network.
+
+    Cached menus are lazy and compact (see Menu) unless lazy=False or
+    compact=False, so orders that only add items by code never pay for
+    building the category tree, and many cached menus share their strings.
+    """
+    def __init__(self, maxsize=64, ttl=600, path=None, lazy=True, compact=True, store=None):
+        super(MenuCache, self).__init__(maxsize, ttl)
+        self.path = path
+        self.store = store
+        self.lazy = lazy
+        self.compact = compact
+        self.loading = {}
+        self.async_loading = {}
+        self.disk_hits = 0
+        if path:
+            os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def key(store_id, lang='en', country=COUNTRY):
+        return (country, str(store_id), lang)
+
+    def get_menu(self, store_id, lang='en', country=COUNTRY):
+        key = self.key(store_id, lang, country)
+        menu = self.get(key)
+        if menu is not None:
+            return menu
+        with self.lock:
+            loading = self.loading.setdefault(key, threading.Lock())
+        with loading:
+            with self.lock:
+                menu = self._lookup(key)
+            if menu is None:
+                response, etag, last_modified = self.read(key), None, None
+                fetched = response is None
+                if fetched:
+                    response, etag, last_modified = request_json_if_modified(
+                        Urls(country).menu_url(), store_id=store_id, lang=lang)
+                else:
+                    self.disk_hits += 1
+                menu = self.add(key, response, etag, last_modified, write=fetched)
+        with self.lock:
+            self.loading.pop(key, None)
+        return menu
+
+    async def async_get_menu(self, store_id, lang='en', country=COUNTRY):
+        """The asyncio version of get_menu.
+
+        Concurrent misses for the same menu on one event loop wait for a
+        single download, and the menu is read from disk, decoded and parsed
+        in a worker thread so the event loop keeps serving other flows.
+        The download runs as a task of its own that every caller waits on
+        through a shield, so cancelling one caller never cancels the others.
+        """
+        import asyncio
+        key = self.key(store_id, lang, country)
+        menu = self.get(key)
+        if menu is not None:
+            return menu
+        loop = asyncio.get_running_loop()
+        flight = (loop, key)
+        task = self.async_loading.get(flight)
+        if task is None:
+            task = self.async_loading[flight] = loop.create_task(self.async_load(key, country))
+            task.add_done_callback(lambda task: self.loaded(flight, task))
+        return await asyncio.shield(task)
+
+    async def async_load(self, key, country):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(None, self.read, key)
+        if response is None:
+            content = await _async_get(Urls(country).menu_url(), store_id=key[1], lang=key[2])
+            return await loop.run_in_executor(None, lambda: self.add(key, decode_json(content)))
+        self.disk_hits += 1
+        return await loop.run_in_executor(None, lambda: self.add(key, response, write=False))
+
+    def loaded(self, flight, task):
+        self.async_loading.pop(flight, None)
+        if not task.cancelled():
+            # Retrieved here too, in case every caller was cancelled
+            task.exception()
+
+    def add(self, key, response, etag=None, last_modified=None, write=True):
+        """Parse a menu response into a Menu and cache it under key.
+
+        With write=False (for responses read back from disk or a
+        MenuStore) the disk copy is left alone, so it keeps its age and
+        still expires after ttl.
+        """
+        menu = Menu(response, key[0], self.lazy, self.compact)
+        menu.store_id, menu.lang = key[1], key[2]
+        menu.etag, menu.last_modified = etag, last_modified
+        if write:
+            self.write(key, response)
+        return self.put(key, menu)
+
+    def refresh(self, store_id, lang='en', country=COUNTRY):
+        """Patch a cached menu in place (see Menu.refresh) and keep it another ttl.
+
+        Menus that have expired but not been evicted yet are refreshed too,
+        so calling this more often than ttl keeps menus cached for good at
+        the cost of a 304 each time. A menu that is not cached is loaded,
+        and None returned instead of the MenuChanges.
+        """
+        key = self.key(store_id, lang, country)
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None:
+            self.get_menu(store_id, lang, country)
+            return None
+        menu = entry[1]
+        response, etag, last_modified = request_json_if_modified(
+            Urls(country).menu_url(), menu.etag, menu.last_modified,
+            store_id=store_id, lang=lang)
+        if response is None:
+            changes = MenuChanges(set(), set(), set(), set())
+            self.touch(key)
+        else:
+            changes = menu.update(response, etag, last_modified)
+            self.write(key, response)
+        self.put(key, menu)
+        return changes
+
+    def refresh_all(self, workers=16):
+        """Refresh every cached menu concurrently, e.g. every few minutes.
+
+        Returns a dict of key to MenuChanges for the menus that changed.
+        Menus that fail to refresh are left as they are, to expire as usual.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        with self.lock:
+            keys = list(self.entries)
+
+        def refresh(key):
+            country, store_id, lang = key
+            try:
+                return key, self.refresh(store_id, lang, country)
+            except Exception:
+                return key, None
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return dict((key, changes) for key, changes in executor.map(refresh, keys)
+                        if changes is not None and any(changes))
+
+    def filename(self, key):
+        return os.path.join(self.path, '{}-{}-{}.json'.format(*key))
+
+    def read(self, key):
+        if self.store is not None and self.store.created + self.ttl >= time.time():
+            response = self.store.load(key)
+            if response is not None:
+                return response
+        if not self.path:
+            return None
+        filename = self.filename(key)
+        try:
+            if os.path.getmtime(filename) + self.ttl < time.time():
+                return None
+            with open(filename, 'rb') as f:
+                return decode_json(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def touch(self, key):
+        if self.path:
+            try:
+                os.utime(self.filename(key))
+            except OSError:
+                pass
+
+    def write(self, key, response):
+        if not self.path:
+            return
+        filename = self.filename(key)
+        temp = '{}.{}.tmp'.format(filename, threading.get_ident())
+        with open(temp, 'w') as f:
+            json.dump(response, f)
+        os.replace(temp, filename)
+
+    def stats(self):
+        stats = super(MenuCache, self).stats()
+        stats['disk_hits'] = self.disk_hits
+        return stats
+
+
+_menu_cache = MenuCache()
+
+
+def get_menu_cache():
+    return _menu_cache
+
+
+def set_menu_cache(cache):
+    """Replace the module's MenuCache, or pass None to turn caching off."""
+    global _menu_cache
+    _menu_cache = cache
+    return cache
+
+
+# A MenuStore file ends with the offset of its index and the time it was written
+_STORE_FOOTER = struct.Struct('<Qd')
+
+
+class MenuStore(object):
+    """A read-only file of many stores' menus, written by warm_menus.
+
+    Menus are kept already decoded, in marshal format, and the file is
+    memory mapped: every process on the node that opens the same file
+    shares its pages, and building a Menu from it skips JSON decoding
+    entirely. marshal's format is tied to the Python version, so the file
+    must be written and read by the same Python.
+
+    Use load() for the raw menu data or get() for a Menu, or give the
+    store to a MenuCache.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        offset, self.created = _STORE_FOOTER.unpack(self.map[-_STORE_FOOTER.size:])
+        self.index = marshal.loads(self.map[offset:-_STORE_FOOTER.size])
+
+    def __repr__(self):
+        return "MenuStore of {} menus in {}".format(len(self.index), self.path)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def load(self, key):
+        """The menu data stored under a MenuCache.key, or None."""
+        entry = self.index.get(key)
+        if entry is None:
+            return None
+        offset, length = entry
+        return marshal.loads(self.map[offset:offset + length])
+
+    def get(self, store_id, lang='en', country=COUNTRY, **kwargs):
+        """Build the Menu of a store from the file, or return None."""
+        data = self.load(MenuCache.key(store_id, lang, country))
+        return None if data is None else Menu(data, country, **kwargs)
 
+    def close(self):
+        self.map.close()
+
+    @staticmethod
+    def write(path, menus):
+        """Write (key, marshalled menu data) pairs to a new MenuStore file.
+
+        The file is written next to path and moved into place, so processes
+        that have the old file open keep a consistent view of it.
+        """
+        index = {}
+        temp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp, 'wb') as f:
+            for key, packed in menus:
+                index[key] = (f.tell(), len(packed))
+                f.write(packed)
+            offset = f.tell()
+            f.write(marshal.dumps(index))
+            f.write(_STORE_FOOTER.pack(offset, time.time()))
+        os.replace(temp, path)
+        return len(index)
+
+
+class CouponCatalog(object):
+    """The coupons of a store, indexed by the products they apply to.
+
+    best() finds the set of coupons that saves the most on an order
+    without two coupons using the same item, entirely locally, so only the
+    winning combination has to be priced by the API (see apply()).
+    Savings are against menu prices, like Order.estimate().
+    """
+    # Only the coupons with the best savings on their own are combined
+    MAX_CANDIDATES = 12
+    # Past this many searched states, best() settles for the best set found
+    MAX_STATES = 20000
+
+    def __init__(self, coupons=()):
+        self.coupons = dict((coupon.code, coupon) for coupon in coupons)
+        self.failed = {}
+        self.by_product = {}
+        for coupon in self.coupons.values():
+            for _, codes in coupon.groups:
+                for code in codes:
+                    self.by_product.setdefault(code, set()).add(coupon.code)
+
+    def __repr__(self):
+        return "CouponCatalog of {} coupons".format(len(self.coupons))
+
+    def __len__(self):
+        return len(self.coupons)
+
+    @classmethod
+    def from_store(cls, store_id, lang='en', country=COUNTRY, codes=None, workers=8):
+        """Load a store's coupons, cached per store (see get_coupon_cache).
+
+        codes defaults to every coupon on the store's menu; each one's
+        definition is fetched from the coupon endpoint. Coupons that could
+        not be loaded are left out and their errors kept in failed, by
+        code; a catalog with failures is not cached, so the next call
+        tries them again.
+        """
+        key = MenuCache.key(store_id, lang, country)
+        cache = _coupon_cache if codes is None else None
+        catalog = cache.get(key) if cache is not None else None
+        if catalog is not None:
+            return catalog
+        from concurrent.futures import ThreadPoolExecutor
+        if codes is None:
+            codes = [coupon.code for coupon in Menu.from_store(store_id, lang, country).coupons]
+        url = Urls(country).coupon_url()
+
+        def load(code):
+            try:
+                return Coupon.from_data(request_json(url, store_id=store_id, couponid=code, lang=lang)), None
+            except Exception as e:
+                return None, e
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            loaded = list(zip(codes, executor.map(load, codes)))
+        catalog = cls([coupon for _, (coupon, _) in loaded if coupon is not None])
+        catalog.failed = dict((code, error) for code, (_, error) in loaded if error is not None)
+        if cache is not None and not catalog.failed:
+            cache.put(key, catalog)
+        return catalog
+
+    @staticmethod
+    def units(order):
+        """Every single item of an order as (code, product code, price)."""
+        units = []
+        for line in order.products:
+            variant = order.menu.variants.get(line['Code'], {})
+            price = float(variant.get('Price') or 0)
+            units.extend([(line['Code'], variant.get('ProductCode'), price)] * line.get('Qty', 1))
+        units.sort(key=lambda unit: -unit[2])
+        return units
+
+    def eligible(self, order):
+        """The coupons that some item of the order can go towards."""
+        codes = set()
+        for line in order.products:
+            codes |= self.by_product.get(line['Code'], set())
+            codes |= self.by_product.get(line.get('ProductCode'), set())
+        return [self.coupons[code] for code in sorted(codes)]
+
+    def best(self, order):
+        """The coupons to use on an order and how much they save together.
+
+        Every coupon is used at most once and every way of filling each
+        coupon's groups with the order's items is considered, so the result
+        is the best set among the MAX_CANDIDATES coupons that save the most
+        on their own. Orders with so many overlapping coupons that the
+        search passes MAX_STATES states get the best set found by then,
+        which is at least as good as taking the best coupon first.
+
+        Items that fit exactly the same groups only differ in price, and
+        however they are shared out the coupons use the most expensive of
+        them, so the search only counts how many of each such class of
+        items are left.
+        """
+        units = self.units(order)
+        coupons = [coupon for coupon in self.eligible(order) if coupon.price is not None and coupon.groups]
+        classes = OrderedDict()
+        for code, product, price in units:
+            fits = tuple((i, g) for i, coupon in enumerate(coupons)
+                         for g, (_, codes) in enumerate(coupon.groups)
+                         if code in codes or product in codes)
+            if fits:
+                classes.setdefault(fits, []).append(price)
+        prices = [sorted(values, reverse=True) for values in classes.values()]
+        counts = tuple(len(values) for values in prices)
+        groups = dict(((i, g), []) for i, coupon in enumerate(coupons) for g in range(len(coupon.groups)))
+        for k, fits in enumerate(classes):
+            for fit in fits:
+                groups[fit].append(k)
+
+        def fillings(i, counts):
+            # Every way coupon i can take items from counts, with its saving
+            coupon = coupons[i]
+            left = list(counts)
+            seen = set()
+
+            def fill(g, j, need, value):
+                if need == 0:
+                    if g + 1 < len(coupon.groups):
+                        yield from fill(g + 1, 0, coupon.groups[g + 1][0], value)
+                    else:
+                        rest = tuple(left)
+                        if rest not in seen:
+                            seen.add(rest)
+                            yield rest, round(value - coupon.price, 2)
+                    return
+                fits = groups[(i, g)]
+                if j == len(fits):
+                    return
+                k = fits[j]
+                taken = len(prices[k]) - left[k]
+                for n in range(min(need, left[k]), -1, -1):
+                    left[k] -= n
+                    yield from fill(g, j + 1, need - n, value + sum(prices[k][taken:taken + n]))
+                    left[k] += n
+
+            return fill(0, 0, coupon.groups[0][0], 0.0)
+
+        candidates = []
+        for i in range(len(coupons)):
+            saved = max((saved for _, saved in fillings(i, counts)), default=0)
+            if saved > 0:
+                candidates.append((saved, i))
+        candidates.sort(key=lambda candidate: -candidate[0])
+        candidates = candidates[:self.MAX_CANDIDATES]
+        # bounds[c] is the most candidates[c:] could save: no coupon saves
+        # more on the items left than on the whole order
+        bounds = [0.0] * (len(candidates) + 1)
+        for c in range(len(candidates) - 1, -1, -1):
+            bounds[c] = bounds[c + 1] + candidates[c][0]
+        memo = {}
+
+        def search(c, counts):
+            # The best coupons among candidates[c:] for the items left
+            if c == len(candidates):
+                return (), 0.0
+            if (c, counts) not in memo:
+                best = ((), 0.0)
+                i = candidates[c][1]
+                if len(memo) < self.MAX_STATES:
+                    for left, saved in sorted(fillings(i, counts), key=lambda filling: -filling[1]):
+                        if saved <= 0 or saved + bounds[c + 1] <= best[1]:
+                            break
+                        chosen, more = search(c + 1, left)
+                        if round(saved + more, 2) > best[1]:
+                            best = ((coupons[i],) + chosen, round(saved + more, 2))
+                if bounds[c + 1] > best[1]:
+                    chosen, saved = search(c + 1, counts)
+                    if saved > best[1]:
+                        best = (chosen, saved)
+                memo[(c, counts)] = best
+            return memo[(c, counts)]
+
+        chosen, saved = search(0, counts)
+        return list(chosen), saved
+
+    def apply(self, order):
+        """Add the best coupons (see best()) to an order and return them."""
+        coupons, _ = self.best(order)
+        for coupon in coupons:
+            if coupon.code not in order.coupons:
+                order.add_coupon(coupon.code)
+        return coupons
+
+
+# Coupon catalogs keyed by MenuCache.key
+_coupon_cache = TTLCache(maxsize=256, ttl=600)
+
+
+def get_coupon_cache():
+    return _coupon_cache
+
+
+def set_coupon_cache(cache):
+    """Replace the coupon catalog cache, or pass None to turn caching off."""
+    global _coupon_cache
+    _coupon_cache = cache
+    return cache
+
+
+def _pack_menu(content):
+    return marshal.dumps(decode_json(content))
+
+
+def warm_menus(store_ids, path, lang='en', country=COUNTRY, workers=8, processes=None):
+    """Download the menus of many stores and write them to a MenuStore file.
+
+    Menus are downloaded on workers threads and decoded on a pool of
+    processes (processes=0 decodes them in this process). Stores whose
+    menu cannot be downloaded are left out. Returns the number of menus
+    written. Worker processes can then share them with
+    set_menu_cache(MenuCache(store=MenuStore(path))).
+    """
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    template = Urls(country).menu_url()
+
+    def download(store_id):
+        try:
+            r = _transport.get(format_url(template, store_id=store_id, lang=lang))
+            r.raise_for_status()
+            return store_id, r.content
+        except Exception:
+            return store_id, None
+
+    with ThreadPoolExecutor(max_workers=workers) as threads:
+        downloaded = [(MenuCache.key(store_id, lang, country), content)
+                      for store_id, content in threads.map(download, store_ids)
+                      if content is not None]
+    contents = [content for _, content in downloaded]
+    if processes == 0:
+        packed = [_pack_menu(content) for content in contents]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            packed = list(pool.map(_pack_menu, contents))
+    return MenuStore.write(path, zip([key for key, _ in downloaded], packed))
+
+
+# The leading digits of each card type, as one regex: the name of the group
+# that matched is the type (see CARD_TYPES)
+CARD_PREFIXES = re.compile(
+    r'(?P<VISA>4)|(?P<MASTERCARD>5[1-5])|(?P<AMEX>3[47])'
+    r'|(?P<DINERS>3(?:0[0-5]|[68]))|(?P<DISCOVER>6(?:011|5))'
+    r'|(?P<JCB>35)|(?P<JCB_15>2131|1800)|(?P<ENROUTE>2014|2149)')
+# Card type and valid lengths of each CARD_PREFIXES group
+CARD_TYPES = {
+    'VISA': ('VISA', (13, 16)),
+    'MASTERCARD': ('MASTERCARD', (16,)),
+    'AMEX': ('AMEX', (15,)),
+    'DINERS': ('DINERS', (14,)),
+    'DISCOVER': ('DISCOVER', (16,)),
+    'JCB': ('JCB', (16,)),
+    'JCB_15': ('JCB', (15,)),
+    'ENROUTE': ('ENROUTE', (15,)),
+}
+CVV = re.compile(r'[0-9]{3,4}')
+ZIP = re.compile(r'[0-9]{5}(?:-[0-9]{4})?')
+
+# Luhn value of each doubled digit, indexed by the digit's ASCII code
+_LUHN_DOUBLE = (0,) * 48 + (0, 2, 4, 6, 8, 1, 3, 5, 7, 9)
+
+CardCheck = namedtuple('CardCheck', ['card_type', 'length_valid', 'luhn_valid'])
+
+
+def luhn_valid(number):
+    """True if a string of digits passes the Luhn checksum."""
+    digits = number.encode('ascii')
+    odd = digits[-1::-2]
+    total = sum(odd) - 48 * len(odd) + sum(_LUHN_DOUBLE[d] for d in digits[-2::-2])
+    return total % 10 == 0
+
+
+def classify_card(number):
+    """Find a card number's type, in one pass over its leading digits.
+
+    Returns a CardCheck: the type ('' if the number is not all digits or no
+    prefix matches), whether the length is valid for that type, and
+    whether the number passes the Luhn checksum.
+    """
+    number = str(number).strip()
+    if not (number.isdigit() and number.isascii()):
+        return CardCheck('', False, False)
+    match = CARD_PREFIXES.match(number)
+    if match is None:
+        return CardCheck('', False, luhn_valid(number))
+    card_type, lengths = CARD_TYPES[match.lastgroup]
+    return CardCheck(card_type, len(number) in lengths, luhn_valid(number))
+
+
+def validate_cards(numbers):
+    """classify_card for many card numbers at once, as a list of CardChecks."""
+    return [classify_card(number) for number in numbers]
 
 
 class CreditCard(object):
@@ -405,21 +2670,15 @@ class CreditCard(object):
         return "Credit Card with last four #{}".format(self.number[-4:])
 
     def validate(self):
-        is_valid = self.number and self.card_type and self.expiration
-        is_valid &= re.match(r'^[0-9]{3,4}$', self.cvv)
-        is_valid &= re.match(r'^[0-9]{5}(?:-[0-9]{4})?$', self.zip)
-        return is_valid
+        check = classify_card(self.number)
+        return bool(check.card_type and check.length_valid and check.luhn_valid
+                    and self.expiration
+                    and CVV.fullmatch(self.cvv)
+                    and ZIP.fullmatch(self.zip))
 
     def find_type(self):
-        patterns = {'VISA': r'^4[0-9]{12}(?:[0-9]{3})?$',
-                    'MASTERCARD': r'^5[1-5][0-9]{14}$',
-                    'AMEX': r'^3[47][0-9]{13}$',
-                    'DINERS': r'^3(?:0[0-5]|[68][0-9])[0-9]{11}$',
-                    'DISCOVER': r'^6(?:011|5[0-9]{2})[0-9]{12}$',
-                    'JCB': r'^(?:2131|1800|35\d{3})\d{11}$',
-                    'ENROUTE': r'^(?:2014|2149)\d{11}$'}
-        return next((card_type for card_type, pattern in list(patterns.items())
-                     if re.match(pattern, self.number)), '')
+        check = classify_card(self.number)
+        return check.card_type if check.length_valid else ''
 
 
 
@@ -452,10 +2711,41 @@ class Store(object):
         print('Order placed for {}'.format(order.customer.first_name))
         return order.place(card=card)
 
-    def get_menu(self, lang='en'):
-        response = request_json(self.urls.menu_url(), store_id=self.id, lang=lang)
-        menu = Menu(response, self.country)
-        return menu
+    def get_menu(self, lang='en', cache=True):
+        return Menu.from_store(self.id, lang=lang, country=self.country, cache=cache)
+
+
+def open_stores(data, service):
+    """Keep the stores of a store-locator response that are online and open
+    for the given service, without building Store objects for the rest."""
+    return [x for x in data['Stores']
+            if x['IsOnlineNow'] and x['ServiceIsOpen'][service]]
+
+
+def address_key(address, service='Delivery'):
+    """The store-locator query for an address, normalized for caching."""
+    clean = lambda s: ' '.join(s.upper().split())
+    return (clean(address.line1), clean(address.line2), service, address.country)
+
+
+# Open stores near an address, keyed by address_key
+_store_cache = TTLCache(maxsize=10000, ttl=60)
+
+
+def get_store_cache():
+    return _store_cache
+
+
+def set_store_cache(cache):
+    """Replace the store-locator cache, or pass None to turn caching off."""
+    global _store_cache
+    _store_cache = cache
+    return cache
+
+
+# The answer for one address of StoreLocator.bulk_nearby_stores: its
+# Stores, or the exception its lookup raised
+StoreLookup = namedtuple('StoreLookup', ['address', 'stores', 'error'])
 
 
 class StoreLocator(object):
@@ -464,16 +2754,62 @@ class StoreLocator(object):
         return 'I locate stores and nothing else'
 
     @staticmethod
-    def nearby_stores(address, service='Delivery'):
+    def nearby_stores(address, service='Delivery', cache=True):
         """Query the API to find nearby stores.
 
         nearby_stores will filter the information we receive from the API
         to exclude stores that are not currently online (!['IsOnlineNow']),
         and stores that are not currently in service (!['ServiceIsOpen']).
         """
-        data = request_json(address.urls.find_url(), line1=address.line1, line2=address.line2, type=service)
-        return [Store(x, address.country) for x in data['Stores']
-                if x['IsOnlineNow'] and x['ServiceIsOpen'][service]]
+        return [Store(x, address.country) for x in StoreLocator.locate(address, service, cache)]
+
+    @staticmethod
+    def locate(address, service='Delivery', cache=True):
+        """The data of the open stores near an address.
+
+        Answers are cached for a short while (see get_store_cache) under the
+        normalized address, so the same address is not looked up twice.
+        """
+        key = address_key(address, service)
+        stores = _store_cache.get(key) if cache and _store_cache is not None else None
+        if stores is None:
+            data = request_json(address.urls.find_url(), line1=address.line1, line2=address.line2, type=service)
+            stores = open_stores(data, service)
+            if _store_cache is not None:
+                _store_cache.put(key, stores)
+        return stores
+
+    @staticmethod
+    def bulk_nearby_stores(addresses, service='Delivery', workers=8, cache=True):
+        """Find the open stores near many addresses at once.
+
+        Returns a StoreLookup for each address, in the same order: its
+        Stores, or the exception its lookup raised, so one failing address
+        does not lose the answers for the others. Addresses that normalize
+        to the same query are only looked up once, and the distinct ones
+        are looked up concurrently.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        addresses = list(addresses)
+        unique = OrderedDict()
+        for address in addresses:
+            unique.setdefault(address_key(address, service), address)
+
+        def locate(address):
+            try:
+                return StoreLocator.locate(address, service, cache), None
+            except Exception as e:
+                return None, e
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            found = dict(zip(unique, executor.map(locate, unique.values())))
+        lookups = []
+        for address in addresses:
+            stores, error = found[address_key(address, service)]
+            if error is None:
+                stores = [Store(x, address.country) for x in stores]
+            lookups.append(StoreLookup(address, stores, error))
+        return lookups
 
     @staticmethod
     def find_closest_store_to_customer(customer, service='Delivery'):
@@ -485,20 +2821,74 @@ class StoreLocator(object):
 
 
 
-def track_by_phone(phone, country=COUNTRY):
+def track_by_phone(phone, country=COUNTRY, stream=False):
     """Query the API to get tracking information.
 
     Not quite sure what this gets you - problem to solve for next time I get pizza. 
+
+    With stream=True this returns a generator of OrderStatus dicts that are
+    parsed as the response arrives (see stream_order_statuses), instead of
+    parsing the whole SOAP envelope first.
     """
     phone = str(phone).strip()
-    data = request_xml(
-        Urls(country).track_by_phone(), 
-        phone=phone
-    )['soap:Envelope']['soap:Body']
+    if stream:
+        return stream_order_statuses(Urls(country).track_by_phone(), phone=phone)
+    return order_statuses(request_xml(Urls(country).track_by_phone(), phone=phone))
+
+
+def order_statuses(document):
+    """Pull the OrderStatus entries out of a parsed tracker SOAP envelope."""
+    data = document['soap:Envelope']['soap:Body']
+    return data['GetTrackerDataResponse']['OrderStatuses']['OrderStatus']
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def _element_dict(element):
+    return dict((_local_name(child.tag), _element_dict(child) if len(child) else child.text)
+                for child in element)
+
 
-    response = data['GetTrackerDataResponse']['OrderStatuses']['OrderStatus']
+def iter_order_statuses(source):
+    """Yield the OrderStatus entries of a tracker SOAP response one by one.
 
-    return response
+    source is a file-like object (or file name). The XML is parsed
+    incrementally and each OrderStatus is turned into a flat dict of its
+    fields and then dropped, so only one order's elements are in memory
+    at a time, whatever the length of the phone number's order history.
+    """
+    from xml.etree import ElementTree
+    parent = None
+    for event, element in ElementTree.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if parent is None and _local_name(element.tag) == 'OrderStatuses':
+                parent = element
+        elif _local_name(element.tag) == 'OrderStatus' and len(element):
+            yield _element_dict(element)
+            if parent is not None:
+                parent.remove(element)
+
+
+def stream_order_statuses(url, **kwargs):
+    """The streaming version of request_xml for tracker responses.
+
+    Reads the response as it arrives and yields its OrderStatus entries
+    (see iter_order_statuses).
+    """
+    start = time.perf_counter() if _metrics is not None else None
+    r = _transport.get(format_url(url, **kwargs), stream=True)
+    if start is not None:
+        _record_request(url, 'GET', start, r.status_code,
+                        int(r.headers.get('Content-Length') or 0))
+    try:
+        r.raise_for_status()
+        r.raw.decode_content = True
+        for status in iter_order_statuses(r.raw):
+            yield status
+    finally:
+        r.close()
 
 
 def track_by_order(store_id, order_key, country=COUNTRY):
@@ -510,104 +2900,590 @@ def track_by_order(store_id, order_key, country=COUNTRY):
         order_key=order_key
     )
 
+
+# Seconds between tracker polls, by the status of the order. Orders move
+# slowly through the kitchen and quickly once they are out the door.
+TRACKER_INTERVALS = {
+    'Routing Station': 60,
+    'Makeline': 45,
+    'Oven': 30,
+    'Rack': 20,
+    'Out the Door': 15,
+}
+TRACKER_INTERVAL = 30
+# Statuses after which an order is no longer polled
+TRACKER_DONE = ('Complete', 'Delivered', 'Bad', 'Void')
+
+TrackerEvent = namedtuple('TrackerEvent', ['key', 'order_id', 'status', 'data'])
+
+
+def tracker_records(response):
+    """Normalize a tracker response to a list of order status dicts."""
+    if isinstance(response, list):
+        return response
+    if isinstance(response, dict) and 'OrderStatuses' in response:
+        records = response['OrderStatuses'] or []
+        if isinstance(records, dict):
+            records = records.get('OrderStatus', [])
+        return records if isinstance(records, list) else [records]
+    return [response] if response else []
+
+
+class Tracker(object):
+    """Polls the tracker for many orders and reports their status changes.
+
+    Register orders with track_phone() or track_order(); identical queries
+    are only polled once however many times they are registered. Each
+    query is polled on a pool of workers, at the shortest of the
+    TRACKER_INTERVALS of the orders it returned (so as often as its most
+    urgent order needs), and is dropped once all of its orders reach a
+    TRACKER_DONE status.
+
+    Only changes are reported, as TrackerEvents passed to callback or,
+    without a callback, queued for events(). Call start() to poll in the
+    background, or poll() to run one round of due queries in the calling
+    thread.
+
+    Errors, whether from a query or from callback, are passed to
+    on_error(key, exception) and never stop a query from being polled.
+    """
+    def __init__(self, callback=None, workers=8, intervals=TRACKER_INTERVALS,
+                 interval=TRACKER_INTERVAL, done=TRACKER_DONE, on_error=None):
+        self.callback = callback
+        self.on_error = on_error
+        self.workers = workers
+        self.intervals = intervals
+        self.interval = interval
+        self.done = done
+        self.queries = {}
+        self.statuses = {}
+        self.schedule = []
+        # With a callback nothing reads the queue, so nothing is put in it
+        self.queue = queue.Queue() if callback is None else None
+        self.lock = threading.Condition()
+        self.thread = None
+        self.running = False
+
+    def __repr__(self):
+        return "Tracker watching {} queries".format(len(self.queries))
+
+    def _register(self, key, query):
+        with self.lock:
+            if key not in self.queries:
+                self.queries[key] = query
+                heapq.heappush(self.schedule, (time.monotonic(), key))
+                self.lock.notify()
+        return key
+
+    def track_phone(self, phone, country=COUNTRY):
+        phone = str(phone).strip()
+        return self._register(('phone', phone, country),
+                              lambda: list(track_by_phone(phone, country, stream=True)))
+
+    def track_order(self, store_id, order_key, country=COUNTRY):
+        return self._register(('order', str(store_id), str(order_key), country),
+                              lambda: track_by_order(store_id, order_key, country))
+
+    def untrack(self, key):
+        with self.lock:
+            self.queries.pop(key, None)
+            for status_key in [k for k in self.statuses if k[0] == key]:
+                del self.statuses[status_key]
+
+    def _poll(self, key, query):
+        """Poll one query, report changes and return the seconds until the next poll."""
+        try:
+            records = tracker_records(query())
+        except Exception as e:
+            self._error(key, e)
+            return self.interval
+        interval, finished = None, bool(records)
+        for record in records:
+            order_id = record.get('OrderID') or key[-2]
+            status = record.get('OrderStatus')
+            with self.lock:
+                changed = self.statuses.get((key, order_id)) != status
+                self.statuses[(key, order_id)] = status
+            if changed:
+                event = TrackerEvent(key, order_id, status, record)
+                if self.queue is not None:
+                    self.queue.put(event)
+                if self.callback:
+                    try:
+                        self.callback(event)
+                    except Exception as e:
+                        self._error(key, e)
+            if status not in self.done:
+                finished = False
+                wait = self.intervals.get(status, self.interval)
+                interval = wait if interval is None else min(interval, wait)
+        if finished:
+            self.untrack(key)
+            return None
+        return interval or self.interval
+
+    def _error(self, key, error):
+        if self.on_error:
+            try:
+                self.on_error(key, error)
+            except Exception:
+                pass
+
+    def _finished(self, key, future):
+        try:
+            interval = future.result()
+        except Exception as e:
+            self._error(key, e)
+            interval = self.interval
+        self._reschedule(key, interval)
+
+    def _due(self):
+        now = time.monotonic()
+        due = []
+        with self.lock:
+            while self.schedule and self.schedule[0][0] <= now:
+                _, key = heapq.heappop(self.schedule)
+                if key in self.queries:
+                    due.append((key, self.queries[key]))
+        return due
+
+    def _reschedule(self, key, interval):
+        if interval is None:
+            return
+        with self.lock:
+            if key in self.queries:
+                heapq.heappush(self.schedule, (time.monotonic() + interval, key))
+                self.lock.notify()
+
+    def poll(self):
+        """Poll every query that is due now, in this thread."""
+        for key, query in self._due():
+            self._reschedule(key, self._poll(key, query))
+
+    def _run(self):
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while self.running:
+                for key, query in self._due():
+                    future = executor.submit(self._poll, key, query)
+                    future.add_done_callback(
+                        lambda f, key=key: self._finished(key, f))
+                with self.lock:
+                    if not self.running:
+                        break
+                    wait = self.schedule[0][0] - time.monotonic() if self.schedule else None
+                    if wait is None or wait > 0:
+                        self.lock.wait(wait)
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            self.thread = threading.Thread(target=self._run, name='pizza-tracker', daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            self.lock.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def events(self, timeout=None):
+        """Yield TrackerEvents as they happen, until none comes for timeout seconds.
+
+        Only for a Tracker without a callback, which gets the events instead.
+        """
+        if self.queue is None:
+            raise Exception('events() needs a Tracker without a callback')
+        while True:
+            try:
+                yield self.queue.get(timeout=timeout)
+            except queue.Empty:
+                return
+
+
+# Asyncio client
+#
+# The classes and functions below mirror the blocking API above, for running
+# many order and tracking flows on one event loop. They share all of the
+# parsing with the blocking versions and only swap the transport for a pooled
+# aiohttp session. aiohttp is imported when the first async request is made.
+
+class AsyncTransport(object):
+    """Pooled aiohttp session, the asyncio counterpart of Transport.
+
+    One ClientSession is shared by every async call. limit caps the number
+    of open connections in total and limit_per_host the number per API host;
+    requests over the limits wait for a free connection, so thousands of
+    flows can be in flight without opening thousands of sockets.
+
+    A ClientSession belongs to the event loop it was opened on, so a new
+    one is opened when the transport is used from another loop (e.g. a
+    second asyncio.run()). Await close() before a loop ends to shut its
+    session down cleanly.
+    """
+    def __init__(self, timeout=TIMEOUT, retries=RETRIES, backoff=BACKOFF,
+                 limit=100, limit_per_host=POOL_SIZE):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.client = None
+        self.loop = None
+
+    def __repr__(self):
+        return "AsyncTransport ({})".format(
+            'open' if self.client and not self.client.closed else 'closed')
+
+    def open(self):
+        import aiohttp
+        import asyncio
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            # The old session's connections belong to the old loop, which
+            # is usually closed by now; they cannot be closed from here.
+            self.client, self.loop = None, loop
+        if self.client is None or self.client.closed:
+            connect, read = self.timeout
+            self.client = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host),
+                timeout=aiohttp.ClientTimeout(sock_connect=connect, sock_read=read),
+            )
+        return self.client
+
+    async def fetch(self, method, url, **kwargs):
+        """Send a request and return the response's status and body (bytes).
+
+        Like Transport, only GETs are retried. An error status raises
+        aiohttp.ClientResponseError, just like raise_for_status().
+        """
+        import aiohttp
+        import asyncio
+        attempts = 1 + (self.retries if method == 'GET' else 0)
+        for attempt in range(attempts):
+            last = attempt + 1 == attempts
+            try:
+                async with self.open().request(method, url, **kwargs) as r:
+                    if last or r.status not in RETRY_STATUSES:
+                        r.raise_for_status()
+                        return r.status, await r.read()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if last:
+                    raise
+            await asyncio.sleep(self.backoff * 2 ** attempt)
+
+    async def request(self, method, url, **kwargs):
+        """Send a request and return the response body as bytes."""
+        status, content = await self.fetch(method, url, **kwargs)
+        return content
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.close()
+            self.client = self.loop = None
+
+
+_async_transport = AsyncTransport()
+
+
+def get_async_transport():
+    return _async_transport
+
+
+def set_async_transport(transport):
+    """Replace the AsyncTransport used by every async call to the API.
+
+    The old transport is returned so the caller can await its close().
+    """
+    global _async_transport
+    old, _async_transport = _async_transport, transport
+    return old
+
+
+async def _async_fetch(method, template, url, start, sent=0, **kwargs):
+    """Send a request and record it with its real status, error statuses too."""
+    import aiohttp
+    try:
+        status, content = await _async_transport.fetch(method, url, **kwargs)
+    except aiohttp.ClientResponseError as e:
+        _record_request(template, method, start, e.status, 0, sent)
+        raise
+    _record_request(template, method, start, status, len(content), sent)
+    return content
+
+
+async def _async_get(url, **kwargs):
+    if _metrics is None:
+        return await _async_transport.get(format_url(url, **kwargs))
+    start = time.perf_counter()
+    return await _async_fetch('GET', url, format_url(url, **kwargs), start)
+
+
+async def async_request_json(url, **kwargs):
+    """The asyncio version of request_json."""
+    return decode_json(await _async_get(url, **kwargs))
+
+
+async def async_request_xml(url, **kwargs):
+    """The asyncio version of request_xml."""
+    import xmltodict
+    return xmltodict.parse(await _async_get(url, **kwargs))
+
+
+class AsyncOrder(Order):
+    """An Order whose price, validate and place calls are coroutines.
+
+    Build one with `await AsyncOrder.begin_customer_order(customer, store)`,
+    which fetches the menu without blocking the event loop, or pass an
+    already loaded Menu as the menu argument.
+    """
+    @staticmethod
+    async def begin_customer_order(customer, store, country=COUNTRY):
+        menu = await Menu.async_from_store(store.id, country=country)
+        return AsyncOrder(store, customer, country=country, menu=menu)
+
+    async def _send(self, url, merge):
+        if _metrics is None:
+            content = await _async_transport.post(url, headers=ORDER_HEADERS, data=self._body())
+            return self._merge(decode_json(content), merge)
+        start = time.perf_counter()
+        body = self._body()
+        sent = _record_phase('order.encode', start)
+        content = await _async_fetch('POST', url, url, sent, len(body), headers=ORDER_HEADERS, data=body)
+        response = self._merge(decode_json(content), merge)
+        _metrics.stage(ORDER_STAGES.get(endpoint_name(url)[1], url), time.perf_counter() - start)
+        return response
+
+    async def price(self, force=False):
+        response = None if force else self._cached(self._priced)
+        if response is None:
+            version = self.version
+            response = await self._send(self.urls.price_url(), True)
+            self._check_price(response)
+            self._priced = (version, response)
+        return response
+
+    async def validate(self):
+        if self.check():
+            return False
+        valid = self._cached(self._validated)
+        if valid is None:
+            version = self.version
+            response = await self._send(self.urls.validate_url(), True)
+            valid = response['Status'] != -1
+            self._validated = (version, valid)
+        return valid
+
+    async def place(self, card=False):
+        await self.pay_with(card)
+        return await self._send(self.urls.place_url(), False)
+
+    async def pay_with(self, card=False):
+        response = await self.price(force=True)
+        self._pay(response, card)
+        return response
+
+
+class AsyncStore(Store):
+    """A Store whose API calls are coroutines."""
+    async def get_details(self):
+        return await async_request_json(self.urls.info_url(), store_id=self.id)
+
+    async def place_order(self, order, card):
+        print('Order placed for {}'.format(order.customer.first_name))
+        return await order.place(card=card)
+
+    async def get_menu(self, lang='en', cache=True):
+        return await Menu.async_from_store(self.id, lang=lang, country=self.country, cache=cache)
+
+
+class AsyncAddress(Address):
+    """An Address whose store lookups are coroutines and return AsyncStores."""
+    async def nearby_stores(self, service='Delivery', cache=True):
+        return await AsyncStoreLocator.nearby_stores(self, service=service, cache=cache)
+
+    async def closest_store(self, service='Delivery'):
+        stores = await self.nearby_stores(service=service)
+        if not stores:
+            raise Exception('No local stores are currently open')
+        return stores[0]
+
+
+class AsyncStoreLocator(object):
+    @staticmethod
+    async def nearby_stores(address, service='Delivery', cache=True):
+        key = address_key(address, service)
+        stores = _store_cache.get(key) if cache and _store_cache is not None else None
+        if stores is None:
+            data = await async_request_json(address.urls.find_url(), line1=address.line1, line2=address.line2, type=service)
+            stores = open_stores(data, service)
+            if _store_cache is not None:
+                _store_cache.put(key, stores)
+        return [AsyncStore(x, address.country) for x in stores]
+
+    @staticmethod
+    async def find_closest_store_to_customer(customer, service='Delivery'):
+        stores = await AsyncStoreLocator.nearby_stores(customer.address, service=service)
+        if not stores:
+            raise Exception('No local stores are currently open')
+        return stores[0]
+
+
+async def async_track_by_phone(phone, country=COUNTRY):
+    """The asyncio version of track_by_phone."""
+    phone = str(phone).strip()
+    return order_statuses(await async_request_xml(Urls(country).track_by_phone(), phone=phone))
+
+
+async def async_track_by_order(store_id, order_key, country=COUNTRY):
+    """The asyncio version of track_by_order."""
+    return await async_request_json(
+        Urls(country).track_by_order(),
+        store_id=store_id,
+        order_key=order_key
+    )
+
 	
 
+def endpoint_templates(base_url, tracker_url):
+    """The URL templates of every endpoint of one country's API.
+
+    base_url is the ordering host (e.g. 'https://order.dominos.com') and
+    tracker_url the tracker host (e.g. 'https://trkweb.dominos.com').
+    """
+    return MappingProxyType({
+        'find_url' : base_url + '/power/store-locator?s={line1}&c={line2}&type={type}',
+        'info_url' : base_url + '/power/store/{store_id}/profile',
+        'menu_url' : base_url + '/power/store/{store_id}/menu?lang={lang}&structured=true',
+        'place_url' : base_url + '/power/place-order',
+        'price_url' : base_url + '/power/price-order',
+        'track_by_order' : tracker_url + '/orderstorage/GetTrackerData?StoreID={store_id}&OrderKey={order_key}',
+        'track_by_phone' : tracker_url + '/orderstorage/GetTrackerData?Phone={phone}',
+        'validate_url' : base_url + '/power/validate-order',
+        'coupon_url' : base_url + '/power/store/{store_id}/coupon/{couponid}?lang={lang}',
+    })
+
+
+# The endpoints of every country, shared by every Urls. Use register_country
+# to change it rather than editing it.
+URLS = MappingProxyType({
+    COUNTRY_USA: endpoint_templates('https://order.dominos.com', 'https://trkweb.dominos.com'),
+    COUNTRY_CANADA: endpoint_templates('https://order.dominos.ca', 'https://trkweb.dominos.ca'),
+    COUNTRY_UK: endpoint_templates('https://order.dominos.co.uk', 'https://trkweb.dominos.co.uk'),
+    COUNTRY_INDIA: endpoint_templates('https://order.dominos.co.in', 'https://trkweb.dominos.co.in'),
+    COUNTRY_JAPAN: endpoint_templates('https://order.dominos.co.jp', 'https://trkweb.dominos.co.jp'),
+})
+
+
+def register_country(country, base_url, tracker_url=None):
+    """Add a country to URLS, or point an existing one somewhere else.
+
+    For example, register_country(COUNTRY_USA, 'http://localhost:8080')
+    sends every US request to a local stand-in server.
+    """
+    global URLS, _endpoints
+    urls = dict(URLS)
+    urls[country] = endpoint_templates(base_url.rstrip('/'), (tracker_url or base_url).rstrip('/'))
+    URLS = MappingProxyType(urls)
+    _endpoints = None
+    return URLS[country]
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_url(template):
+    return tuple((literal, field) for literal, field, _, _ in string.Formatter().parse(template))
+
+
+def format_url(template, **params):
+    """Fill in a URL template, escaping every parameter for the query string.
+
+    Templates are parsed once and cached, so this is cheaper than
+    str.format, and an address like '1 Main St #2' is sent as it is
+    instead of cutting the query short.
+    """
+    parts = []
+    for literal, field in _compile_url(template):
+        parts.append(literal)
+        if field is not None:
+            parts.append(quote(str(params[field]), safe=''))
+    return ''.join(parts)
+
+
 class Urls(object):
     """URLs for doing different things to the API.
 
-    This initializes some dicts that contain country-unique information
-    on how to interact with the API, and some getter methods for getting
-    to that information. These are handy to pass as a first argument to
-    pizza.utils.request_[xml|json].
+    This is a light view of one country's endpoints in the shared URLS
+    registry, with some getter methods for getting to them. These are
+    handy to pass as a first argument to request_[xml|json], or build()
+    fills one in directly.
     """
-    def __init__(self, country=COUNTRY):
+    __slots__ = ('country',)
 
+    def __init__(self, country=COUNTRY):
         self.country = country
-        self.urls = {
-            COUNTRY_USA: {
-                'find_url' : 'https://order.dominos.com/power/store-locator?s={line1}&c={line2}&type={type}',
-                'info_url' : 'https://order.dominos.com/power/store/{store_id}/profile',
-                'menu_url' : 'https://order.dominos.com/power/store/{store_id}/menu?lang={lang}&structured=true',
-                'place_url' : 'https://order.dominos.com/power/place-order',
-                'price_url' : 'https://order.dominos.com/power/price-order',
-                'track_by_order' : 'https://trkweb.dominos.com/orderstorage/GetTrackerData?StoreID={store_id}&OrderKey={order_key}',
-                'track_by_phone' : 'https://trkweb.dominos.com/orderstorage/GetTrackerData?Phone={phone}',
-                'validate_url' : 'https://order.dominos.com/power/validate-order',
-                'coupon_url' : 'https://order.dominos.com/power/store/{store_id}/coupon/{couponid}?lang={lang}',
-            },
-            COUNTRY_CANADA: {
-                'find_url' : 'https://order.dominos.ca/power/store-locator?s={line1}&c={line2}&type={type}',
-                'info_url' : 'https://order.dominos.ca/power/store/{store_id}/profile',
-                'menu_url' : 'https://order.dominos.ca/power/store/{store_id}/menu?lang={lang}&structured=true',
-                'place_url' : 'https://order.dominos.ca/power/place-order',
-                'price_url' : 'https://order.dominos.ca/power/price-order',
-                'track_by_order' : 'https://trkweb.dominos.ca/orderstorage/GetTrackerData?StoreID={store_id}&OrderKey={order_key}',
-                'track_by_phone' : 'https://trkweb.dominos.ca/orderstorage/GetTrackerData?Phone={phone}',
-                'validate_url' : 'https://order.dominos.ca/power/validate-order',
-                'coupon_url' : 'https://order.dominos.ca/power/store/{store_id}/coupon/{couponid}?lang={lang}',
-            },
-			COUNTRY_UK: {
-				'find_url' : 'https://order.dominos.co.uk/power/store-locator?s={line1}&c={line2}&type={type}',
-				'info_url' : 'https://order.dominos.co.uk/power/store/{store_id}/profile',
-				'menu_url' : 'https://order.dominos.co.uk/power/store/{store_id}/menu?lang={lang}&structured=true',
-				'place_url' : 'https://order.dominos.co.uk/power/place-order',
-				'price_url' : 'https://order.dominos.co.uk/power/price-order',
-				'track_by_order' : 'https://trkweb.dominos.co.uk/orderstorage/GetTrackerData?StoreID={store_id}&OrderKey={order_key}',
-				'track_by_phone' : 'https://trkweb.dominos.co.uk/orderstorage/GetTrackerData?Phone={phone}',
-				'validate_url' : 'https://order.dominos.co.uk/power/validate-order',
-				'coupon_url' : 'https://order.dominos.co.uk/power/store/{store_id}/coupon/{couponid}?lang={lang}',
-			},
-			COUNTRY_INDIA: {
-				'find_url' : 'https://order.dominos.co.in/power/store-locator?s={line1}&c={line2}&type={type}',
-				'info_url' : 'https://order.dominos.co.in/power/store/{store_id}/profile',
-				'menu_url' : 'https://order.dominos.co.in/power/store/{store_id}/menu?lang={lang}&structured=true',
-				'place_url' : 'https://order.dominos.co.in/power/place-order',
-				'price_url' : 'https://order.dominos.co.in/power/price-order',
-				'track_by_order' : 'https://trkweb.dominos.co.in/orderstorage/GetTrackerData?StoreID={store_id}&OrderKey={order_key}',
-				'track_by_phone' : 'https://trkweb.dominos.co.in/orderstorage/GetTrackerData?Phone={phone}',
-				'validate_url' : 'https://order.dominos.co.in/power/validate-order',
-				'coupon_url' : 'https://order.dominos.co.in/power/store/{store_id}/coupon/{couponid}?lang={lang}',
-				
-					},
-			COUNTRY_JAPAN: {
-				'find_url' : 'https://order.dominos.co.jp/power/store-locator?s={line1}&c={line2}&type={type}',
-				'info_url' : 'https://order.dominos.co.jp/power/store/{store_id}/profile',
-				'menu_url' : 'https://order.dominos.co.jp/power/store/{store_id}/menu?lang={lang}&structured=true',
-				'place_url' : 'https://order.dominos.co.jp/power/place-order',
-				'price_url' : 'https://order.dominos.co.jp/power/price-order',
-				'track_by_order' : 'https://trkweb.dominos.co.jp/orderstorage/GetTrackerData?StoreID={store_id}&OrderKey={order_key}',
-				'track_by_phone' : 'https://trkweb.dominos.co.jp/orderstorage/GetTrackerData?Phone={phone}',
-				'validate_url' : 'https://order.dominos.co.jp/power/validate-order',
-				'coupon_url' : 'https://order.dominos.co.jp/power/store/{store_id}/coupon/{couponid}?lang={lang}',
-        }
-    
+
+    def __repr__(self):
+        return "Urls for {}".format(self.country)
+
+    @property
+    def urls(self):
+        return URLS
+
+    def build(self, endpoint, **params):
+        return format_url(URLS[self.country][endpoint], **params)
+
     def find_url(self):
-        return self.urls[self.country]['find_url']
-    
+        return URLS[self.country]['find_url']
+
     def info_url(self):
-        return self.urls[self.country]['info_url']
+        return URLS[self.country]['info_url']
 
     def menu_url(self):
-        return self.urls[self.country]['menu_url']
+        return URLS[self.country]['menu_url']
 
     def place_url(self):
-        return self.urls[self.country]['place_url']
+        return URLS[self.country]['place_url']
 
     def price_url(self):
-        return self.urls[self.country]['price_url']
+        return URLS[self.country]['price_url']
 
     def track_by_order(self):
-        return self.urls[self.country]['track_by_order']
+        return URLS[self.country]['track_by_order']
 
     def track_by_phone(self):
-        return self.urls[self.country]['track_by_phone']
-    
+        return URLS[self.country]['track_by_phone']
+
     def validate_url(self):
-        return self.urls[self.country]['validate_url']
-    
+        return URLS[self.country]['validate_url']
+
     def coupon_url(self):
-        return self.urls[self.country]['coupon_url']
-    
-    
+        return URLS[self.country]['coupon_url']
+
+
 if __name__ == "__main__":
+    if sys.argv[1:2] == ['warm']:
+        import argparse
+        parser = argparse.ArgumentParser(prog='pizza.py warm', description='Prefetch store menus into a MenuStore file.')
+        parser.add_argument('output')
+        parser.add_argument('store_ids', nargs='+')
+        parser.add_argument('--country', default=COUNTRY, choices=sorted(URLS))
+        parser.add_argument('--lang', default='en')
+        parser.add_argument('--workers', type=int, default=8)
+        parser.add_argument('--processes', type=int, default=None)
+        parser.add_argument('--base-url', help="the country's API host, e.g. a local stand-in (see register_country)")
+        args = parser.parse_args(sys.argv[2:])
+        if args.base_url:
+            register_country(args.country, args.base_url)
+        count = warm_menus(args.store_ids, args.output, args.lang, args.country, args.workers, args.processes)
+        print('Wrote {} of {} menus to {}'.format(count, len(args.store_ids), args.output))
+        exit(0 if count == len(args.store_ids) else 1)
     exit("This script should not be run directly. Use 'from pizza import *' to import and use the API in a Python 3.x interpreter.")
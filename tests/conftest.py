@@ -0,0 +1,48 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pizza  # noqa: E402
+from stub import StubServer, make_menu  # noqa: E402
+
+
+@pytest.fixture
+def fresh(monkeypatch):
+    """Fresh module-wide transports, caches and metrics, restored afterwards."""
+    monkeypatch.setattr(pizza, 'URLS', pizza.URLS)
+    monkeypatch.setattr(pizza, '_endpoints', None)
+    monkeypatch.setattr(pizza, '_transport', pizza.Transport(retries=0))
+    monkeypatch.setattr(pizza, '_async_transport', pizza.AsyncTransport(retries=0))
+    monkeypatch.setattr(pizza, '_menu_cache', pizza.MenuCache())
+    monkeypatch.setattr(pizza, '_store_cache', pizza.TTLCache(maxsize=100, ttl=60))
+    monkeypatch.setattr(pizza, '_coupon_cache', pizza.TTLCache(maxsize=100, ttl=60))
+    monkeypatch.setattr(pizza, '_metrics', None)
+    yield pizza
+    pizza._transport.close()
+
+
+@pytest.fixture
+def stub(fresh):
+    """A StubServer that every US endpoint points at."""
+    with StubServer() as server:
+        pizza.register_country(pizza.COUNTRY_USA, server.url)
+        yield server
+
+
+@pytest.fixture
+def menu():
+    return pizza.Menu(make_menu(products=40))
+
+
+@pytest.fixture
+def customer():
+    return pizza.Customer('Ann', 'Baker', 'ann@example.com', '5555550100',
+                          '1 Main St, Springfield, IL, 62701')
+
+
+@pytest.fixture
+def order(customer, menu):
+    return pizza.Order(pizza.Store({'StoreID': 1}), customer, menu=menu)
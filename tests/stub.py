@@ -0,0 +1,189 @@
+"""A local stand-in for the Dominos API, for the tests and benchmarks.
+
+StubServer serves a generated menu, a store locator, coupons, both
+tracker endpoints and the price, validate and place endpoints from a
+thread, and counts the requests it gets. Point pizza at it with
+register_country(COUNTRY_USA, server.url).
+"""
+import json
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+SIZES = ('10', '12', '14', '16')
+WORDS = ('Pepperoni', 'Cheese', 'Hawaiian', 'Veggie', 'Coke', 'Sprite', 'Wings',
+         'Bread', 'Pasta', 'Cookie', 'Deluxe', 'Supreme')
+TOPPINGS = ('X', 'C', 'P', 'H', 'M', 'O', 'G', 'N', 'K')
+
+TRACKER_XML = '''<?xml version="1.0"?>
+<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/"><soap:Body>
+<GetTrackerDataResponse xmlns="http://www.dominos.com/message/"><OrderStatuses>
+{}
+</OrderStatuses></GetTrackerDataResponse></soap:Body></soap:Envelope>'''
+
+TRACKER_STATUS = ('<OrderStatus><StoreID>{store}</StoreID><OrderID>{order}</OrderID>'
+                  '<Phone>{phone}</Phone><OrderStatus>{status}</OrderStatus></OrderStatus>')
+
+
+def make_menu(products=400, coupons=20, seed=1):
+    """A structured menu response with products in four sizes each.
+
+    Product i is S_P<i> and its variants <size>P<i>; coupons are 9000 up.
+    """
+    rnd = random.Random(seed)
+    variants, items = {}, {}
+    for i in range(products):
+        code = 'S_P%d' % i
+        name = '%s %s %d' % (rnd.choice(WORDS), rnd.choice(WORDS), i)
+        for size in SIZES:
+            variants['%sP%d' % (size, i)] = {
+                'Code': '%sP%d' % (size, i), 'Name': '%s" %s' % (size, name),
+                'Price': '%.2f' % (5 + rnd.random() * 15), 'ProductCode': code,
+                'SizeCode': size, 'FlavorCode': 'HANDTOSS',
+                'Tags': {'DefaultToppings': ','.join('%s=1' % t for t in rnd.sample(TOPPINGS, 3)),
+                         'Specialty': False},
+            }
+        items[code] = {'Code': code, 'Name': name, 'ProductType': 'Pizza', 'Description': name,
+                       'Variants': ['%sP%d' % (size, i) for size in SIZES]}
+    deals = dict(('9%03d' % i, {'Code': '9%03d' % i, 'Name': 'Deal %d' % i,
+                                'Price': '%.2f' % (9 + i), 'Tags': {}}) for i in range(coupons))
+    preconfigured = dict(('PRE%d' % i, {'Code': 'PRE%d' % i, 'Name': 'Pre %d' % i}) for i in range(5))
+    codes = list(items)
+
+    def category(code, products, subcategories=()):
+        return {'Code': code, 'Name': code, 'Products': products, 'Categories': list(subcategories)}
+
+    food = category('Food', [], [
+        category('Pizza', codes[:products // 2], [category('Specialty', codes[:10])]),
+        category('Sides', codes[products // 2:]),
+    ])
+    return {
+        'Variants': variants, 'Products': items, 'Coupons': deals,
+        'PreconfiguredProducts': preconfigured,
+        'Categorization': {'Food': food, 'Coupons': category('Coupons', list(deals)),
+                           'PreconfiguredProducts': category('PreconfiguredProducts', list(preconfigured))},
+    }
+
+
+class StubServer(object):
+    """The stub API on a free local port. Use as a context manager.
+
+    menu is the menu response; change it with set_menu(), which also
+    changes its ETag. statuses is a list of order statuses the tracker
+    answers with, one per poll, the last one over and over. fail maps a
+    path, or a street the store locator is asked about, to the HTTP
+    status to answer it with instead, and delay maps a path to the
+    seconds to wait before answering it.
+    """
+    def __init__(self, menu=None, statuses=('Oven',)):
+        self.counts = {}
+        self.fail = {}
+        self.delay = {}
+        self.statuses = list(statuses)
+        self.polls = 0
+        self.lock = threading.Lock()
+        self.set_menu(menu or make_menu())
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def set_menu(self, menu):
+        self.menu = menu
+        self.menu_body = json.dumps(menu).encode()
+        self.etag = '"%08x"' % zlib.crc32(self.menu_body)
+
+    def count(self, path):
+        with self.lock:
+            self.counts[path] = self.counts.get(path, 0) + 1
+
+    def status(self):
+        with self.lock:
+            status = self.statuses[min(self.polls, len(self.statuses) - 1)]
+            self.polls += 1
+        return status
+
+    def get(self, path, query, headers):
+        if path.endswith('/menu'):
+            if headers.get('If-None-Match') == self.etag:
+                return 304, b'', 'application/json', {'ETag': self.etag}
+            return 200, self.menu_body, 'application/json', {'ETag': self.etag}
+        if path == '/power/store-locator':
+            if query['s'][0] in self.fail:
+                return self.fail[query['s'][0]], b'{}', 'application/json', {}
+            stores = [{'StoreID': 1, 'IsOnlineNow': True, 'ServiceIsOpen': {'Delivery': True},
+                       'AddressDescription': '1 Main St'},
+                      {'StoreID': 2, 'IsOnlineNow': False, 'ServiceIsOpen': {'Delivery': True},
+                       'AddressDescription': '2 Main St'}]
+            return 200, json.dumps({'Stores': stores}).encode(), 'application/json', {}
+        if path.endswith('/profile'):
+            return 200, json.dumps({'StoreID': path.split('/')[3], 'IsOpen': True}).encode(), 'application/json', {}
+        if '/coupon/' in path:
+            code = path.rsplit('/', 1)[1]
+            coupon = {'Code': code, 'Name': 'Deal %s' % code, 'Price': '10.00',
+                      'ProductGroups': [{'RequiredQty': 2, 'ProductCodes': ['S_P1', 'S_P2', 'S_P3']}]}
+            return 200, json.dumps(coupon).encode(), 'application/json', {}
+        if path == '/orderstorage/GetTrackerData':
+            status = self.status()
+            if 'OrderKey' in query:
+                body = {'OrderID': query['OrderKey'][0], 'StoreID': query['StoreID'][0], 'OrderStatus': status}
+                return 200, json.dumps(body).encode(), 'application/json', {}
+            orders = TRACKER_STATUS.format(store=1, order='A1', phone=query['Phone'][0], status=status)
+            return 200, TRACKER_XML.format(orders).encode(), 'text/xml', {}
+        return 404, b'{}', 'application/json', {}
+
+    def post(self, path, body):
+        order = json.loads(body)['Order']
+        amount = sum(float(self.menu['Variants'].get(line['Code'], {}).get('Price', 0)) * line.get('Qty', 1)
+                     for line in order['Products'])
+        response = dict(order, Amounts={'Customer': round(amount * 1.08, 2), 'Menu': round(amount, 2)},
+                        OrderID='OID-%d' % self.counts[path], Junk='x')
+        status = -1 if not order['Products'] else 1
+        return 200, json.dumps({'Status': status, 'Order': response}).encode(), 'application/json', {}
+
+    def handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def respond(self, status, body, content_type, headers):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                stub.count(url.path)
+                time.sleep(stub.delay.get(url.path, 0))
+                if url.path in stub.fail:
+                    return self.respond(stub.fail[url.path], b'{}', 'application/json', {})
+                self.respond(*stub.get(url.path, parse_qs(url.query), self.headers))
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                stub.count(self.path)
+                if self.path in stub.fail:
+                    return self.respond(stub.fail[self.path], b'{}', 'application/json', {})
+                self.respond(*stub.post(self.path, body))
+
+        return Handler
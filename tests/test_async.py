@@ -0,0 +1,104 @@
+import asyncio
+
+import aiohttp
+import pytest
+
+import pizza
+
+
+def run(coroutine):
+    """Run a coroutine on a new loop and close the async session before it ends."""
+    async def main():
+        try:
+            return await coroutine
+        finally:
+            await pizza.get_async_transport().close()
+    return asyncio.run(main())
+
+
+def test_async_price_validate_place(stub, customer, menu):
+    order = pizza.AsyncOrder(pizza.AsyncStore({'StoreID': 1}), customer, menu=menu)
+    order.add_item('12P1')
+
+    async def flow():
+        priced = await order.price()
+        assert await order.price() is priced
+        assert await order.validate()
+        return await order.place()
+
+    assert run(flow())['Order']['OrderID']
+    assert stub.counts['/power/price-order'] == 2
+    assert stub.counts['/power/place-order'] == 1
+
+
+def test_async_menu_is_downloaded_once_for_concurrent_calls(stub):
+    store = pizza.AsyncStore({'StoreID': 1})
+
+    async def flow():
+        return await asyncio.gather(*[store.get_menu() for _ in range(50)])
+
+    menus = run(flow())
+    assert all(menu is menus[0] for menu in menus)
+    assert stub.counts['/power/store/1/menu'] == 1
+    assert not pizza.get_menu_cache().async_loading
+
+
+def test_cancelling_one_menu_caller_leaves_the_others_waiting(stub):
+    stub.delay['/power/store/1/menu'] = 0.2
+    store = pizza.AsyncStore({'StoreID': 1})
+
+    async def flow():
+        first = asyncio.ensure_future(store.get_menu())
+        second = asyncio.ensure_future(store.get_menu())
+        await asyncio.sleep(0.05)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert '12P1' in run(flow()).variants
+    assert stub.counts['/power/store/1/menu'] == 1
+    assert pizza.Menu.from_store(1) is pizza.get_menu_cache().get(pizza.MenuCache.key(1))
+
+
+def test_async_transport_follows_the_running_loop(stub):
+    run(pizza.AsyncStore({'StoreID': 1}).get_details())
+    assert run(pizza.AsyncStore({'StoreID': 1}).get_details())['IsOpen']
+    assert stub.counts['/power/store/1/profile'] == 2
+
+
+def test_async_tracking_and_stores(stub, customer):
+    address = pizza.AsyncAddress('1 Main St', 'Springfield', 'IL', '62701')
+
+    async def flow():
+        store = await address.closest_store()
+        by_phone = await pizza.async_track_by_phone('5555550100')
+        by_order = await pizza.async_track_by_order(1, 'A1')
+        return store, by_phone, by_order
+
+    store, by_phone, by_order = run(flow())
+    assert isinstance(store, pizza.AsyncStore) and store.id == '1'
+    assert by_phone['OrderStatus'] == by_order['OrderStatus'] == 'Oven'
+
+
+def test_async_metrics_record_real_statuses(stub, customer, menu):
+    metrics = pizza.set_metrics(pizza.HistogramMetrics())
+    stub.fail['/power/validate-order'] = 503
+    stub.fail['/power/store/9/profile'] = 404
+    order = pizza.AsyncOrder(pizza.AsyncStore({'StoreID': 1}), customer, menu=menu)
+    order.add_item('12P1')
+
+    async def flow():
+        await order.price()
+        with pytest.raises(aiohttp.ClientResponseError):
+            await order.validate()
+        with pytest.raises(aiohttp.ClientResponseError):
+            await pizza.AsyncStore({'StoreID': 9}).get_details()
+
+    run(flow())
+    assert metrics.statuses[('price_url', 200)] == 1
+    assert metrics.statuses[('validate_url', 503)] == 1
+    assert metrics.statuses[('info_url', 404)] == 1
+    summary = metrics.summary()
+    assert summary['phase.order.encode']['count'] == 2
+    assert summary['stage.price']['count'] == 1
@@ -0,0 +1,27 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Imported by the functions that first need them, never by 'import pizza'
+HEAVY_MODULES = ('requests', 'urllib3', 'xmltodict', 'aiohttp', 'asyncio', 'concurrent.futures',
+                 'xml.etree.ElementTree', 'hashlib', 'difflib', 'uuid')
+
+
+def loaded_after(code):
+    """The HEAVY_MODULES loaded after running code in a fresh interpreter."""
+    check = '%s; import sys; print(" ".join(m for m in %r if m in sys.modules))' % (code, HEAVY_MODULES)
+    done = subprocess.run([sys.executable, '-c', check], cwd=ROOT, capture_output=True, text=True, check=True)
+    return done.stdout.split()
+
+
+def test_import_loads_no_heavy_modules():
+    assert loaded_after('import pizza') == []
+    assert loaded_after('from pizza import *') == []
+
+
+def test_cards_and_addresses_load_no_heavy_modules():
+    code = ('import pizza; pizza.CreditCard("4111111111111111", "0130", "123", "62701").validate(); '
+            'pizza.Customer("A", "B", "a@b.c", "1", "1 Main St, Springfield, IL, 62701").address.line2')
+    assert loaded_after(code) == []
@@ -0,0 +1,275 @@
+import copy
+import marshal
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import pizza
+from stub import make_menu
+
+
+def old_display(menu):
+    """The lines the original Menu.display printed, for comparison."""
+    lines = []
+
+    def print_category(category, depth=1):
+        indent = "  " * (depth + 1)
+        if len(category.products) + len(category.subcategories) > 0:
+            lines.append(indent + category.name)
+            for subcategory in category.subcategories:
+                print_category(subcategory, depth + 1)
+            for product in category.products:
+                lines.append(indent + "  [%s] %s" % (product.code, product.name))
+    lines.append("************ Coupon Menu ************")
+    print_category(menu.root_categories['Coupons'])
+    lines.append("\n************ Preconfigured Menu ************")
+    print_category(menu.root_categories['PreconfiguredProducts'])
+    lines.append("\n************ Regular Menu ************")
+    print_category(menu.root_categories['Food'])
+    return lines
+
+
+def changed_menu(data):
+    """A copy of a menu response with a variant, a product and a category changed."""
+    data = copy.deepcopy(data)
+    data['Variants']['12P1']['Price'] = '1.00'
+    data['Products']['S_P2']['Name'] = 'Renamed'
+    del data['Variants']['10P3']
+    data['Categorization']['Food']['Categories'][1]['Products'].pop()
+    return data
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'lazy': True}, {'compact': True}, {'lazy': True, 'compact': True}])
+def test_menu_modes_agree(kwargs):
+    data = make_menu(products=40)
+    eager = pizza.Menu(copy.deepcopy(data))
+    menu = pizza.Menu(copy.deepcopy(data), **kwargs)
+    assert dict(menu.variants['12P1']) == eager.variants['12P1']
+    assert [item.code for item in menu.products] == [item.code for item in eager.products]
+    assert list(menu.render()) == list(eager.render())
+
+
+def test_search():
+    menu = pizza.Menu(make_menu(products=40))
+    name = menu.variants['12P7']['Name'].split()[1]
+    results = menu.search(Name=name.lower(), SizeCode='12')
+    assert results and all(name in v['Name'] and v['SizeCode'] == '12' for v in results)
+    assert [v['Code'] for v in menu.search(ProductCode='S_P7')] == ['10P7', '12P7', '14P7', '16P7']
+    assert [v['Code'] for v in menu.search(Code=['12P1', '14P2'])] == ['12P1', '14P2']
+
+
+def test_render_matches_the_original_display():
+    menu = pizza.Menu(make_menu(products=40))
+    assert list(menu.render()) == old_display(menu)
+
+
+def test_category_tree():
+    menu = pizza.Menu(make_menu(products=40))
+    tree = menu.tree
+    food = menu.root_categories['Food']
+    pizzas, sides = food.subcategories
+    specialty = pizzas.subcategories[0]
+    assert tree.contains(food, specialty) and not tree.contains(sides, specialty)
+    assert tree.path(specialty) == specialty.get_category_path() == 'FoodPizzaSpecialty'
+    assert set(item.code for item in tree.products_under(food)) == set(item.code for item in menu.products)
+    assert set(category.code for category in tree.categories_of('S_P1')) == {'Pizza', 'Specialty'}
+
+
+@pytest.mark.parametrize('lazy', [True, False])
+@pytest.mark.parametrize('keep_raw', [True, False])
+def test_update_reports_and_applies_changes(lazy, keep_raw):
+    data = make_menu(products=40)
+    menu = pizza.Menu(copy.deepcopy(data), lazy=lazy, keep_raw=keep_raw)
+    changes = menu.update(changed_menu(data))
+    assert changes.added == set()
+    assert changes.removed == {'10P3'}
+    assert changes.changed == {'12P1', 'S_P2'}
+    assert changes.categories == {'Food'}
+    assert menu.variants['12P1']['Price'] == '1.00'
+    assert menu.menu_by_code['S_P2'].name == 'Renamed'
+    assert list(menu.render()) == old_display(pizza.Menu(changed_menu(data)))
+
+
+def test_search_and_render_while_the_menu_is_updated():
+    data = make_menu(products=200)
+    versions = [data, changed_menu(data)]
+    menu = pizza.Menu(copy.deepcopy(data))
+    errors = []
+    done = threading.Event()
+
+    def read():
+        try:
+            while not done.is_set():
+                menu.search(Name='pepperoni', Price='1')
+                list(menu.render())
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=read) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for i in range(20):
+        menu.update(copy.deepcopy(versions[i % 2]))
+    done.set()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+
+def test_materialized_menu_keeps_only_fingerprints():
+    menu = pizza.Menu(make_menu(products=40))
+    assert all(item.menu_data is None for item in menu.products)
+    for section in menu._sections.values():
+        assert all(isinstance(value, int) for value in section.values())
+
+
+def test_refresh_costs_a_304_when_nothing_changed(stub):
+    menu = pizza.Menu.from_store(1, cache=False)
+    assert not any(menu.refresh())
+    assert stub.counts['/power/store/1/menu'] == 2
+    stub.set_menu(changed_menu(stub.menu))
+    assert menu.refresh().changed == {'12P1', 'S_P2'}
+    assert menu.variants['12P1']['Price'] == '1.00'
+    assert not any(menu.refresh())
+
+
+def test_menu_cache_reads_fresh_menus_from_disk(stub, tmp_path):
+    path = str(tmp_path)
+    pizza.set_menu_cache(pizza.MenuCache(path=path, ttl=60))
+    pizza.Menu.from_store(1)
+    filename = pizza.get_menu_cache().filename(pizza.MenuCache.key(1))
+    written = time.time() - 30
+    os.utime(filename, (written, written))
+
+    pizza.set_menu_cache(pizza.MenuCache(path=path, ttl=60))
+    assert '12P1' in pizza.Menu.from_store(1).variants
+    assert pizza.get_menu_cache().disk_hits == 1
+    assert os.path.getmtime(filename) == pytest.approx(written)
+    assert stub.counts['/power/store/1/menu'] == 1
+
+    os.utime(filename, (written - 60, written - 60))
+    pizza.set_menu_cache(pizza.MenuCache(path=path, ttl=60))
+    pizza.Menu.from_store(1)
+    assert stub.counts['/power/store/1/menu'] == 2
+
+
+def test_best_coupons_beat_the_greedy_choice(customer):
+    data = make_menu(products=10)
+    data['Variants']['12P1']['Price'] = '9.95'
+    data['Variants']['12P2']['Price'] = '5.94'
+    order = pizza.Order(pizza.Store({'StoreID': 1}), customer, menu=pizza.Menu(data))
+    order.add_item('12P1', 2)
+    order.add_item('12P2')
+    a = pizza.Coupon('A', price=10.0, groups=((2, frozenset(['S_P1', 'S_P2'])),))
+    b = pizza.Coupon('B', price=2.0, groups=((1, frozenset(['S_P1'])),))
+    catalog = pizza.CouponCatalog([a, b])
+    assert catalog.best(order) == ([a, b], 13.84)
+    assert catalog.apply(order) == [a, b]
+    assert 'A' in order.coupons and 'B' in order.coupons
+
+
+def test_coupon_catalog_from_store(stub):
+    catalog = pizza.CouponCatalog.from_store(1)
+    assert len(catalog) == 20
+    assert pizza.CouponCatalog.from_store(1) is catalog
+    assert catalog.coupons['9001'].groups == ((2, frozenset(['S_P1', 'S_P2', 'S_P3'])),)
+
+
+def test_coupon_catalog_with_failed_coupons_is_not_cached(stub):
+    stub.fail['/power/store/1/coupon/9003'] = 503
+    catalog = pizza.CouponCatalog.from_store(1)
+    assert len(catalog) == 19 and list(catalog.failed) == ['9003']
+    del stub.fail['/power/store/1/coupon/9003']
+    catalog = pizza.CouponCatalog.from_store(1)
+    assert len(catalog) == 20 and not catalog.failed
+    assert pizza.CouponCatalog.from_store(1) is catalog
+
+
+def test_cards():
+    assert pizza.classify_card('4111111111111111') == ('VISA', True, True)
+    assert pizza.classify_card('4111111111111112') == ('VISA', True, False)
+    assert pizza.classify_card('4111 1111') == ('', False, False)
+    assert pizza.CreditCard('5555555555554444', '0130', '123', '62701').validate()
+    assert not pizza.CreditCard('5555555555554444', '0130', '12', '62701').validate()
+
+
+def test_format_url_escapes_parameters():
+    url = pizza.format_url('http://x/{store_id}/find?s={line1}', store_id=1, line1='1 Main St #2&x')
+    assert url == 'http://x/1/find?s=1%20Main%20St%20%232%26x'
+
+
+def test_recorded_requests_replay(stub, tmp_path):
+    path = str(tmp_path / 'cassette.jsonl')
+    recorder = pizza.RecordingTransport(path, pizza.Transport(retries=0))
+    pizza.set_transport(recorder)
+    recorded = pizza.Menu.from_store(1, cache=False)
+    recorder.close()
+
+    pizza.set_transport(pizza.ReplayTransport(path))
+    replayed = pizza.Menu.from_store(1, cache=False)
+    assert replayed.variants == recorded.variants
+    assert stub.counts['/power/store/1/menu'] == 1
+    with pytest.raises(Exception):
+        pizza.Menu.from_store(2, cache=False)
+
+
+def test_menu_store_round_trip(tmp_path):
+    path = str(tmp_path / 'menus.bin')
+    menus = {pizza.MenuCache.key(1): make_menu(products=10), pizza.MenuCache.key(2): make_menu(products=5, seed=2)}
+    assert pizza.MenuStore.write(path, [(key, marshal.dumps(data)) for key, data in menus.items()]) == 2
+    with open(path, 'rb') as f:
+        content = f.read()
+    offset, created = pizza._STORE_FOOTER.unpack(content[-pizza._STORE_FOOTER.size:])
+    assert created == pytest.approx(time.time(), abs=5)
+    index = marshal.loads(content[offset:-pizza._STORE_FOOTER.size])
+    assert sorted(index) == sorted(menus)
+
+    store = pizza.MenuStore(path)
+    assert len(store) == 2 and pizza.MenuCache.key(1) in store
+    assert store.created == created
+    for key, data in menus.items():
+        assert store.load(key) == data
+    assert store.load(pizza.MenuCache.key(3)) is None
+    assert store.get(2, lazy=True).variants == menus[pizza.MenuCache.key(2)]['Variants']
+    store.close()
+
+
+def test_warmed_menus_are_served_without_downloading(stub, tmp_path):
+    path = str(tmp_path / 'menus.bin')
+    stub.fail['/power/store/2/menu'] = 500
+    assert pizza.warm_menus([1, 2], path, processes=0) == 1
+    assert stub.counts['/power/store/1/menu'] == 1
+
+    store = pizza.MenuStore(path)
+    pizza.set_menu_cache(pizza.MenuCache(store=store, ttl=60))
+    assert pizza.Menu.from_store(1).variants['12P1'] == stub.menu['Variants']['12P1']
+    assert stub.counts['/power/store/1/menu'] == 1
+
+    store.created -= 120
+    pizza.set_menu_cache(pizza.MenuCache(store=store, ttl=60))
+    pizza.Menu.from_store(1)
+    assert stub.counts['/power/store/1/menu'] == 2
+    store.close()
+
+
+def test_warm_command(stub, tmp_path):
+    path = str(tmp_path / 'menus.bin')
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    def warm(*store_ids):
+        command = [sys.executable, 'pizza.py', 'warm', path, '--base-url', stub.url, '--processes', '1']
+        return subprocess.run(command + list(store_ids), cwd=root, capture_output=True, text=True)
+
+    done = warm('1')
+    assert done.returncode == 0 and 'Wrote 1 of 1 menus' in done.stdout
+    store = pizza.MenuStore(path)
+    assert store.load(pizza.MenuCache.key(1)) == stub.menu
+    store.close()
+
+    stub.fail['/power/store/2/menu'] = 500
+    done = warm('1', '2')
+    assert done.returncode == 1 and 'Wrote 1 of 2 menus' in done.stdout
@@ -0,0 +1,233 @@
+import json
+import threading
+import time
+import zlib
+
+import pytest
+
+import pizza
+from stub import StubServer as pizza_stub
+
+
+def test_cart_merges_and_removes_one_add_at_a_time(order):
+    order.add_item('12P1')
+    order.add_item('12P1')
+    order.add_item('12P1', options=['X'])
+    assert [(line['Code'], line['Qty']) for line in order.products] == [('12P1', 2), ('12P1', 1)]
+    order.remove_item('12P1')
+    assert [line['Qty'] for line in order.products] == [2]
+    order.remove_item('12P1')
+    assert [line['Qty'] for line in order.products] == [1]
+    order.remove_item('12P1')
+    assert not order.products
+    with pytest.raises(Exception):
+        order.remove_item('12P1')
+
+
+def test_cart_lines_do_not_share_menu_variants(order, menu):
+    line = order.add_item('12P1')
+    line['Qty'] = 5
+    assert 'Qty' not in menu.variants['12P1']
+
+
+def test_estimate_and_check(order, menu):
+    assert order.check() == ['order has no products']
+    order.add_item('12P1', 2)
+    price = float(menu.variants['12P1']['Price'])
+    assert order.estimate()['Total'] == round(price * 2, 2)
+    assert order.check() == []
+
+
+def test_body_sends_edits_made_in_place(order):
+    order.add_item('12P1')
+    order._body()
+    order.data['Address']['Street'] = '2 Elm St'
+    assert b'2 Elm St' in order._body()
+
+
+def test_price_validate_place(stub, order):
+    order.add_item('12P1')
+    assert order.price()['Status'] == 1
+    assert order.price() is order.price()
+    assert stub.counts['/power/price-order'] == 1
+    assert order.validate()
+    response = order.place()
+    assert response['Order']['OrderID']
+    assert order.data['Payments'] == [{'Type': 'Cash'}]
+    assert stub.counts['/power/place-order'] == 1
+
+
+def test_place_orders_reports_each_order(stub, customer, menu):
+    store = pizza.Store({'StoreID': 1})
+    orders = [pizza.Order(store, customer, menu=menu) for _ in range(5)]
+    for order in orders[1:]:
+        order.add_item('12P1')
+    results = list(pizza.place_orders(orders, workers=4, rate=0))
+    assert len(results) == 5
+    failed = [result for result in results if result.error]
+    assert [result.order for result in failed] == [orders[0]]
+    assert stub.counts['/power/place-order'] == 4
+
+
+def test_error_status_raises(stub, order):
+    stub.fail['/power/price-order'] = 500
+    order.add_item('12P1')
+    with pytest.raises(Exception):
+        order.price()
+
+
+def test_menu_from_store_is_cached(stub):
+    menu = pizza.Menu.from_store(1)
+    assert pizza.Menu.from_store(1) is menu
+    assert stub.counts['/power/store/1/menu'] == 1
+
+
+def test_nearby_stores_are_cached(stub, customer):
+    stores = customer.address.nearby_stores()
+    assert [store.id for store in stores] == ['1']
+    customer.address.nearby_stores()
+    assert stub.counts['/power/store-locator'] == 1
+    assert pizza.StoreLocator.find_closest_store_to_customer(customer).id == '1'
+
+
+def test_bulk_nearby_stores_reports_each_address(stub):
+    stub.fail['9 Nowhere Rd'] = 500
+    addresses = [pizza.Address('1 Main St', 'Springfield', 'IL', '62701'),
+                 pizza.Address('9 Nowhere Rd', 'Springfield', 'IL', '62701'),
+                 pizza.Address(' 1 main st ', 'springfield', 'il', '62701')]
+    lookups = pizza.StoreLocator.bulk_nearby_stores(addresses, workers=2)
+    assert [lookup.address for lookup in lookups] == addresses
+    assert [store.id for store in lookups[0].stores] == ['1'] and lookups[0].error is None
+    assert lookups[1].stores is None and lookups[1].error is not None
+    assert [store.id for store in lookups[2].stores] == ['1']
+    assert stub.counts['/power/store-locator'] == 2
+
+
+def test_track_by_phone(stub):
+    assert pizza.track_by_phone('5555550100')['OrderStatus'] == 'Oven'
+    statuses = list(pizza.track_by_phone('5555550100', stream=True))
+    assert [(status['OrderID'], status['OrderStatus']) for status in statuses] == [('A1', 'Oven')]
+
+
+def test_track_by_order(stub):
+    assert pizza.track_by_order(1, 'A1')['OrderStatus'] == 'Oven'
+
+
+def test_tracker_reports_changes_until_done(fresh):
+    with pizza_stub(statuses=('Makeline', 'Makeline', 'Oven', 'Complete')) as server:
+        pizza.register_country(pizza.COUNTRY_USA, server.url)
+        events = []
+        tracker = pizza.Tracker(callback=events.append, intervals={})
+        key = tracker.track_order(1, 'A1')
+        for _ in range(4):
+            tracker.schedule = [(0, key)] if key in tracker.queries else []
+            tracker.poll()
+    assert [event.status for event in events] == ['Makeline', 'Oven', 'Complete']
+    assert not tracker.queries
+
+
+def test_tracker_queues_events_only_without_a_callback(stub):
+    tracker = pizza.Tracker()
+    tracker.track_order(1, 'A1')
+    tracker.poll()
+    assert [event.status for event in tracker.events(timeout=0)] == ['Oven']
+
+    tracker = pizza.Tracker(callback=lambda event: None)
+    tracker.track_order(1, 'A1')
+    tracker.poll()
+    assert tracker.queue is None
+    with pytest.raises(Exception):
+        next(tracker.events(timeout=0))
+
+
+def test_tracker_survives_a_failing_callback(stub):
+    errors = []
+
+    def callback(event):
+        raise ValueError(event.status)
+
+    tracker = pizza.Tracker(callback=callback, on_error=lambda key, e: errors.append(e))
+    key = tracker.track_order(1, 'A1')
+    tracker.poll()
+    assert len(errors) == 1 and key in tracker.queries and tracker.schedule
+
+
+def test_order_state_round_trip(order, menu):
+    order.add_item('12P1', 2, options=['X'])
+    order.add_coupon('9001')
+    restored = pizza.Order.from_state(order.state(), menu)
+    assert restored.products.to_list() == order.products.to_list()
+    assert restored.coupons.to_list() == order.coupons.to_list()
+    assert restored.data['Address'] == order.data['Address']
+
+
+def test_order_queue_resumes_and_never_places_twice(stub, tmp_path, order, menu):
+    order.add_item('12P1')
+    path = str(tmp_path / 'orders.wal')
+    queue = pizza.OrderQueue(path)
+    queue.put(order, key='intake-1')
+    queue.put(order, key='intake-2')
+    queue.write('intake-2', 'placing')
+    queue.close()
+
+    queue = pizza.OrderQueue(path)
+    assert queue.pending() == ['intake-1']
+    assert queue.in_doubt() == ['intake-2']
+    assert [result.error for result in queue.run(menus={'1': menu}, rate=0)] == [None]
+    queue.compact()
+    queue.put(order, key='intake-1')
+    assert queue.pending() == []
+    queue.close()
+    assert stub.counts['/power/place-order'] == 1
+    with pytest.raises(Exception):
+        queue.put(order)
+
+
+def test_order_queue_logs_a_key_put_at_once_by_many_intakes_once(monkeypatch, tmp_path, order):
+    queue = pizza.OrderQueue(str(tmp_path / 'orders.wal'), sync=False)
+    barrier = threading.Barrier(16)
+    state = order.state
+    monkeypatch.setattr(order, 'state', lambda: time.sleep(0.01) or state())
+
+    def intake(i):
+        barrier.wait()
+        queue.put(order, key='intake-%d' % (i % 2))
+
+    threads = [threading.Thread(target=intake, args=(i,)) for i in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    queue.write('intake-0', 'placed')
+    queue.put(order, key='intake-0')
+    queue.close()
+    assert queue.records == 3
+    assert pizza.OrderQueue(str(tmp_path / 'orders.wal')).stage('intake-0') == 'placed'
+
+
+def test_order_queue_log_is_json(tmp_path, order):
+    path = str(tmp_path / 'orders.wal')
+    queue = pizza.OrderQueue(path)
+    queue.put(order, key='intake-1')
+    queue.compact()
+    queue.close()
+    with open(path, 'rb') as f:
+        content = f.read()
+    length, crc = pizza._RECORD_HEADER.unpack_from(content)
+    payload = content[pizza._RECORD_HEADER.size:]
+    assert len(payload) == length and zlib.crc32(payload) == crc
+    key, stage, state, error = json.loads(payload)
+    assert (key, stage, error) == ('intake-1', 'queued', None)
+    assert state['Products'] == order.products.to_list()
+
+
+def test_order_queue_cuts_off_a_torn_record(tmp_path, order):
+    path = str(tmp_path / 'orders.wal')
+    queue = pizza.OrderQueue(path)
+    queue.put(order, key='intake-1')
+    queue.close()
+    with open(path, 'ab') as f:
+        f.write(b'\x40\x00\x00\x00partial')
+    queue = pizza.OrderQueue(path)
+    assert queue.pending() == ['intake-1']
+    queue.close()